@@ -1,6 +1,10 @@
 import asyncio
+import collections
+import heapq
 import json
 import os
+import queue
+import threading
 import time
 import datetime
 import secrets
@@ -58,14 +62,111 @@ NAMES = {
     "rain_XL_XXL": "дождевик XL-XXL",
 }
 
-orders = baydb.BayDB("orders.json", indexes=["status", "user_id"])
+orders = baydb.AsyncBayDB("orders.json", indexes=[("status", "bitmap"), "user_id", "payment_transaction_id", ("create_time", "sorted")], durability=baydb.DURABILITY_GROUP,
+                          checkpoint_every=1000, compact_ratio=0.5,
+                          aggregates={"items_by_status": ("counters", "order.order", "status")},
+                          schema=["user_id", "user_nick", "user_name", "order", "status", "create_time", "code", "payment_transaction_id"],
+                          metrics=True, query_cache_size=64)
 
 application = None
 
+# Списки заказов показываются страницами по ORDERS_PAGE_SIZE штук
+ORDERS_PAGE_SIZE = 10
+ADMIN_ORDER_LISTS = {
+    "paid": "PAID",
+    "approve": "WAITING_APPROVE",
+    "ready": "READY",
+}
+
+# Выполненные и отменённые заказы старше сезона при старте уходят в архив (orders.json.cold):
+# они не занимают память и индексы, но по-прежнему находятся через orders.get()
+ARCHIVE_STATUSES = ["DONE", "CANCELED"]
+ARCHIVE_AFTER_DAYS = 180
+
 ADMINS = [53684567, 117711124, 329347, 116563916]
 
 #, 5068140821, 117711124, 1813518716, 1035477903, 321169743]
 
+EKB_TIMEZONE = pytz.timezone('Asia/Yekaterinburg')
+
+# Лог действий пишется в фоне: раз в LOG_FLUSH_INTERVAL секунд и при остановке бота
+LOG_FLUSH_INTERVAL = 1.0
+LOG_MAX_OPEN_FILES = 64
+
+
+class ActivityLog:
+    """
+    Лог действий пользователей: log/log.txt и log/log_{user_id}.txt.
+    Middleware только кладёт событие в очередь, а фоновый поток пачками
+    дописывает их в файлы и держит открытыми последние max_open_files из них.
+    """
+
+    def __init__(self, directory, flush_interval=LOG_FLUSH_INTERVAL, max_open_files=LOG_MAX_OPEN_FILES):
+        self._directory = directory
+        self._flush_interval = flush_interval
+        self._max_open_files = max_open_files
+        self._queue = queue.SimpleQueue()
+        self._files = collections.OrderedDict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="activity-log", daemon=True)
+        self._thread.start()
+
+    def log(self, user_id, user_name, text):
+        self._queue.put((time.time(), user_id, user_name, text))
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write_pending()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            self._write_pending()
+
+    def _write_pending(self):
+        entries = collections.defaultdict(list)
+        while True:
+            try:
+                created, user_id, user_name, text = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            timestamp = datetime.datetime.fromtimestamp(created, tz=EKB_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+            log_entry = f"[{timestamp}] {user_id} ({user_name}): {text}\n"
+            entries["log.txt"].append(log_entry)
+            if user_id != "unknown":
+                entries[f"log_{user_id}.txt"].append(log_entry)
+
+        for name, lines in entries.items():
+            try:
+                f = self._file(name)
+                f.write("".join(lines))
+                f.flush()
+            except OSError as e:
+                print(f"Failed to write to {name}: {e}")
+
+    def _file(self, name):
+        f = self._files.get(name)
+        if f is not None:
+            self._files.move_to_end(name)
+            return f
+
+        f = self._files[name] = open(os.path.join(self._directory, name), "a", encoding="utf-8")
+        if len(self._files) > self._max_open_files:
+            _, oldest = self._files.popitem(last=False)
+            oldest.close()
+        return f
+
+
+activity_log = ActivityLog("log")
+
+
 async def logging_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user:
         user_id = update.effective_user.id
@@ -74,27 +175,16 @@ async def logging_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id = "unknown"
         user_name = "Unknown User"
 
-    log_entry = ""
-    ekb_timezone = pytz.timezone('Asia/Yekaterinburg')
-    timestamp = datetime.datetime.now(tz=ekb_timezone).strftime("%Y-%m-%d %H:%M:%S")
-
     if update.callback_query:
-        callback_data = update.callback_query.data
-        log_entry = f"[{timestamp}] {user_id} ({user_name}): {callback_data}\n"
+        text = update.callback_query.data
     elif update.effective_message:
-        message_text = update.effective_message.text or update.effective_message.caption or "No text"
+        text = update.effective_message.text or update.effective_message.caption or "No text"
         if update.effective_message.web_app_data:
-            message_text = f"Web app data: {update.effective_message.web_app_data.data}"
-        log_entry = f"[{timestamp}] {user_id} ({user_name}): {message_text}\n"
+            text = f"Web app data: {update.effective_message.web_app_data.data}"
     else:
-        log_entry = f"[{timestamp}] {user_id} ({user_name}): Unknown update type\n"
+        text = "Unknown update type"
 
-    with open("log/log.txt", "a", encoding="utf-8") as f:
-        f.write(log_entry)
-
-    if user_id != "unknown":
-        with open(f"log/log_{user_id}.txt", "a", encoding="utf-8") as f:
-            f.write(log_entry)
+    activity_log.log(user_id, user_name, text)
 
 
 def calculate_order_price(order_items):
@@ -228,9 +318,8 @@ def format_order_details(order, include_timestamp=True, for_admins=False):
         message = "<b>Заказ готов к выдаче!</b>\n\n" + message
     
     if for_admins:
-        ekb_tz = pytz.timezone('Asia/Yekaterinburg')
         create_datetime = datetime.datetime.fromtimestamp(order["create_time"], tz=pytz.UTC)
-        create_time_ekb = create_datetime.astimezone(ekb_tz).strftime("%d-%m-%Y %H:%M:%S")
+        create_time_ekb = create_datetime.astimezone(EKB_TIMEZONE).strftime("%d-%m-%Y %H:%M:%S")
         message += f"Создан: {create_time_ekb}\n"
         message += f"Создатель: {order_user_name}\n"
         # if "code" in order:
@@ -344,8 +433,7 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
     # Log to file
-    ekb_timezone = pytz.timezone('Asia/Yekaterinburg')
-    timestamp = datetime.datetime.now(tz=ekb_timezone).strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = datetime.datetime.now(tz=EKB_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
     log_entry = f"[{timestamp}] ERROR: {error_message}\n"
 
     try:
@@ -399,51 +487,67 @@ async def web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     order["status"] = "NEW"
     order["create_time"] = int(time.time())
 
-    order = orders.append(order)
+    order = await orders.append(order)
     
     message, markup = format_order_details(order)
 
     await update.message.reply_html(text=message, reply_markup=markup, disable_web_page_preview=True)
 
 
-async def admin_get_paid_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id not in ADMINS:
-        await update.message.reply_html(text="Доступ запрещён")
-        return
+def order_list_conditions(view, user_id):
+    """Условия выборки для списков заказов, которые показываются страницами"""
+    if view == "my":
+        return {"user_id": user_id, "status__ne": "CANCELED"}
+    return {"status": ADMIN_ORDER_LISTS[view]}
 
-    paid_orders = list(orders.where(status="PAID"))
 
-    if not paid_orders:
-        await update.message.reply_text("Пока нет заказов.")
+async def send_orders_page(message, view, user_id, cursor=None):
+    """Отправляет страницу заказов и, если есть ещё, кнопку для следующей страницы"""
+    page = orders.where(limit=ORDERS_PAGE_SIZE, after=cursor, **order_list_conditions(view, user_id))
+
+    if not page.records and cursor is None:
+        await message.reply_text("У вас пока нет заказов." if view == "my" else "Пока нет заказов.")
         return
 
-    for order in paid_orders:
-        status = order["status"]
-        order_id = order["id"]
+    for order in page.records:
+        text, markup = format_order_details(order, for_admins=view != "my")
+        await message.reply_text(text, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
 
-        message, markup = format_order_details(order, for_admins=True)
-        await update.message.reply_text(message, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
+    if page.cursor is not None:
+        # callback_data в Telegram ограничена 64 байтами, курсор занимает около 20
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("⏬ Ещё", callback_data=f"more:{view}:{page.cursor}")]])
+        await message.reply_text("Показаны не все заказы", reply_markup=markup)
 
 
-async def admin_get_wait_approval_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def next_orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, view, cursor = query.data.split(":", 2)
+
+    if view != "my" and update.effective_user.id not in ADMINS:
+        await query.answer("Ошибка: доступ запрещён")
+        return
+
+    await query.answer()
+    await send_orders_page(query.message, view, update.effective_user.id, cursor)
+    await query.message.delete()
+
+
+async def admin_get_paid_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in ADMINS:
         await update.message.reply_html(text="Доступ запрещён")
         return
 
-    paid_orders = list(orders.where(status="WAITING_APPROVE"))
+    await send_orders_page(update.message, "paid", user_id)
 
-    if not paid_orders:
-        await update.message.reply_text("Пока нет заказов.")
-        return
 
-    for order in paid_orders:
-        status = order["status"]
-        order_id = order["id"]
+async def admin_get_wait_approval_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMINS:
+        await update.message.reply_html(text="Доступ запрещён")
+        return
 
-        message, markup = format_order_details(order, for_admins=True)
-        await update.message.reply_text(message, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
+    await send_orders_page(update.message, "approve", user_id)
 
 
 async def admin_get_ready_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -452,18 +556,19 @@ async def admin_get_ready_orders(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_html(text="Доступ запрещён")
         return
 
-    ready_orders = list(orders.where(status="READY"))
+    await send_orders_page(update.message, "ready", user_id)
 
-    if not ready_orders:
-        await update.message.reply_text("Пока нет заказов.")
-        return
 
-    for order in ready_orders:
-        status = order["status"]
-        order_id = order["id"]
+async def admin_db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMINS:
+        await update.message.reply_html(text="Доступ запрещён")
+        return
 
-        message, markup = format_order_details(order, for_admins=True)
-        await update.message.reply_text(message, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
+    # Статистика базы заказов: размеры, индексы, счётчики и задержки операций
+    stats = json.dumps(orders.stats(), ensure_ascii=False, indent=1)
+    input_file = io.BytesIO(stats.encode("utf-8"))
+    await update.message.reply_document(document=input_file, filename="orders_stats.json", caption="Статистика базы заказов")
 
 
 async def admin_get_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -492,21 +597,7 @@ async def admin_get_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_orders = list(orders.where(user_id=user_id))
-    
-    user_orders = [order for order in user_orders if order["status"] != "CANCELED"]
-    
-    if not user_orders:
-        await update.message.reply_text("У вас пока нет заказов.")
-        return
-    
-    for order in user_orders:
-        status = order["status"]
-        order_id = order["id"]
-        
-        message, markup = format_order_details(order)
-        await update.message.reply_text(message, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
+    await send_orders_page(update.message, "my", update.effective_user.id)
 
 
 async def admin_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -541,14 +632,14 @@ async def admin_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
             return
 
         if action == "admin_paid":
-            order = orders.update(order_id, status="PAID")
+            order = await orders.update(order_id, status="PAID")
             await context.bot.send_message(order_user_id, f"Заказ {order_id} оплачен.\nМы напишем, когда его можно будет забрать 🙌", disable_web_page_preview=True)
 
             message, markup = format_order_details(order, include_timestamp=False, for_admins=True)
             await query.edit_message_text(message, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
 
         elif action == "admin_not_paid":
-            order = orders.update(order_id, status="WAITING_PAYMENT")
+            order = await orders.update(order_id, status="WAITING_PAYMENT")
             await context.bot.send_message(order_user_id, f"Мы не нашли ваш платёж по заказу {order_id}. Если вы заплатили, напишите @IamALENO4KA или @bay3255", parse_mode="HTML", disable_web_page_preview=True)
 
             await query.edit_message_text(text=f"Заказ {order_id}: вы не нашли платёж пользователя. Ему выслано отовещение об этом", parse_mode="HTML", disable_web_page_preview=True)
@@ -559,7 +650,7 @@ async def admin_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
         if action == "admin_ready":
             code = f"{secrets.randbelow(10000):04}"
-            order = orders.update(order_id, status="READY", code=code)
+            order = await orders.update(order_id, status="READY", code=code)
 
             user_message, user_markup = format_order_details(order, include_timestamp=False, for_admins=False)
             await context.bot.send_message(order_user_id, user_message, reply_markup=user_markup, parse_mode="HTML", disable_web_page_preview=True)
@@ -574,7 +665,7 @@ async def admin_button_callback(update: Update, context: ContextTypes.DEFAULT_TY
             await query.answer(f"Плохое состояние заказа: {status}")
             return
 
-        order = orders.update(order_id, status="DONE")
+        order = await orders.update(order_id, status="DONE")
 
         user_message, user_markup = format_order_details(order, include_timestamp=False, for_admins=False)
         await context.bot.send_message(order_user_id, user_message, reply_markup=user_markup, parse_mode="HTML", disable_web_page_preview=True)
@@ -589,6 +680,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
 
+    if data.startswith("more:"):
+        await next_orders_page(update, context)
+        return
+
     action, order_id = data.rsplit("_", 1)
     order_id = int(order_id)
     order = orders.get(order_id)
@@ -637,7 +732,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     next_state = action_to_next_state[action]
 
-    order = orders.update(order_id, status=next_state)
+    order = await orders.update(order_id, status=next_state)
     await query.answer()
 
     if action == "cancel":
@@ -668,8 +763,22 @@ def generate_orders_csv():
     headers = ["Номер", "Заказ", "Подарок", "Статус", "Пользователь", "Имя пользователя", "Стоимость", "Доставка", "Адрес/ПВЗ", "ФИО получателя", "Телефон", "Дата создания", "Код получения"]
     writer.writerow(headers)
 
-    # Получаем все заказы
-    all_orders = [orders.get(order_id) for order_id in orders.keys()]
+    # Получаем все заказы, отсортированные по времени создания (от новых к старым), и суммы по статусам
+    # из одного снимка базы: выгрузка согласована, даже если заказы меняются по ходу
+    with orders.snapshot_view() as view:
+        all_orders = list(view.range("create_time", reverse=True))
+        items_by_status = view.aggregate("items_by_status")
+        # Заказы, заархивированные при старте (см. start_approver), не входят ни в индексы, ни в суммы
+        archived_orders = list(view.archived())
+
+    for order in archived_orders:
+        status_items = items_by_status.setdefault(order["status"], {})
+        for item, count in order["order"].get("order", {}).items():
+            status_items[item] = status_items.get(item, 0) + count
+    # Заказы из индекса уже отсортированы: сортируем только архивные и сливаем их вместе
+    by_create_time = lambda order: order.get("create_time") or 0
+    archived_orders.sort(key=by_create_time, reverse=True)
+    all_orders = list(heapq.merge(all_orders, archived_orders, key=by_create_time, reverse=True))
 
     # Группируем заказы по статусу
     orders_by_status = {}
@@ -692,11 +801,9 @@ def generate_orders_csv():
         writer.writerow(["", f"===== СТАТУС: {status} ====="])
         writer.writerow([])
 
-        # Сортируем заказы внутри группы по времени создания (от новых к старым)
         status_orders = orders_by_status[status]
-        status_orders.sort(key=lambda x: x.get("create_time", 0), reverse=True)
 
-        sum_of_orders = {}
+        sum_of_orders = items_by_status.get(status, {})
         sum_price = 0
 
         # Добавляем данные в CSV
@@ -710,9 +817,8 @@ def generate_orders_csv():
             # Форматируем дату создания
             create_time = order.get("create_time", 0)
             if create_time:
-                ekb_tz = pytz.timezone('Asia/Yekaterinburg')
                 create_datetime = datetime.datetime.fromtimestamp(create_time, tz=pytz.UTC)
-                create_time_ekb = create_datetime.astimezone(ekb_tz).strftime("%Y-%m-%d %H:%M:%S")
+                create_time_ekb = create_datetime.astimezone(EKB_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
             else:
                 create_time_ekb = "Неизвестно"
 
@@ -760,12 +866,6 @@ def generate_orders_csv():
             # Записываем строку
             writer.writerow([order_id, order_items, is_gift, status, user_nick, user_name, total_price, delivery_type, address, recipient_name, recipient_phone, create_time_ekb, code])
 
-            for item, count in order["order"]["order"].items():
-                if item not in sum_of_orders:
-                    sum_of_orders[item] = 0
-
-                sum_of_orders[item] += count
-
             sum_price += total_price
 
         writer.writerow([
@@ -864,20 +964,31 @@ async def start(update: Update, context: CallbackContext):
 
 
 async def start_approver(application):
+    archived = await orders.archive(status__in=ARCHIVE_STATUSES,
+                                    create_time__lt=time.time() - ARCHIVE_AFTER_DAYS * 24 * 60 * 60)
+    if archived:
+        print(f"Archived {archived} orders")
     asyncio.create_task(tasks.pay_approver(bot=application.bot, orders=orders))
 
 
+async def close_orders(application):
+    await orders.close()
+    activity_log.close()
+
+
 def main():
     os.makedirs("log", exist_ok=True)
+    activity_log.start()
 
     global application
-    application = Application.builder().token(TOKEN).post_init(start_approver).build()
+    application = Application.builder().token(TOKEN).post_init(start_approver).post_shutdown(close_orders).build()
 
     # Add middleware for logging
     application.add_handler(TypeHandler(Update, logging_middleware), group=-1)
 
     # Add regular handlers
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("stats", admin_db_stats))
     application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, web_app_data))
     application.add_handler(MessageHandler(filters.Regex("^Мои заказы 🛍$"), my_orders))
     application.add_handler(MessageHandler(filters.Regex("^Неподтверждённые ⏳$"), admin_get_wait_approval_orders))
@@ -15,110 +15,2495 @@ Examples:
 
     # Retrieving records
     record = orders.get(42)  # {'id': 42, 'product': 'T-shirt', 'status': 'WAIT'}
+    record.id, record["status"]  # records are read-only views, no copying
+    mutable = record.copy()  # plain dict for callers that modify it
 
     # Searching by index
     wait_orders = orders.where(status="WAIT")  # list of records
+    user_orders = orders.where(user_id=7, status__ne="CANCELED")
+    active = orders.where(status__in=["WAIT", "PAID"], product="Mug")  # product is filtered by scan
     unique_record = orders.get(uniq=42)  # single record or None
 
+    # Queries: eq, ne, in, lt, le, gt, ge and exists on top-level or nested
+    # fields ("__" or "." between parts), with an optional projection
+    big = orders.query(["id", "order.total_price"], order__total_price__ge=10000, status="PAID")
+    unpaid = orders.query(status__in=["NEW", "WAITING_PAYMENT"], payment_transaction_id__exists=False)
+
+    # Indexes over nested fields and computed values, unique ones too
+    orders = BayDB("orders.json", indexes=["order.delivery_id", ("nick", lambda r: r["user_nick"].lower(), True)])
+    pvz_orders = orders.where(**{"order.delivery_id": "pvz"})
+    order = orders.get(nick="badbadbar")
+
+    # Bitmap indexes for fields with a few values: conditions over them are
+    # combined as bit operations and counted without touching records
+    orders = BayDB("orders.json", indexes=[("status", "bitmap"), ("delivery", "bitmap")])
+    orders.count(status__ne="CANCELED", delivery="pvz")
+
+    # Pages: up to limit records plus an opaque cursor for the next page (None
+    # on the last one). Pages resume from the last record, not an offset, so
+    # inserts and deletes between calls don't shift them
+    page = orders.where(limit=10, status="PAID")
+    page = orders.where(limit=10, after=page.cursor, status="PAID")
+    newest = orders.where(limit=10, order_by="-create_time", user_id=7)
+
     # Getting all values for an index
     all_statuses = orders.values("status")  # ["WAIT", "PAID"]
 
-    # Updating records
-    orders.update(42, status="PAID")
+    # Sorted indexes keep records ordered by a field
+    orders = BayDB("orders.json", indexes=["status", ("create_time", "sorted")])
+    last_hour = orders.range("create_time", time.time() - 3600)  # lo <= create_time < hi
+    latest_paid = orders.range("create_time", reverse=True, limit=20, status="PAID")
+
+    # Aggregates are kept up to date on every write: count of records, sum
+    # of a field or item-wise sum of a dict of counters, optionally grouped
+    orders = BayDB("orders.json", indexes=["status"], aggregates={
+        "per_status": ("count", "status"),
+        "revenue": ("sum", "order.total_price"),
+        "items": ("counters", "order.order", "status"),
+    })
+    orders.aggregate("per_status")  # {"WAIT": 2, "PAID": 1}
+    orders.aggregate("items", "PAID")  # {"T-shirt": 3}
+
+    # Updating records
+    orders.update(42, status="PAID")
+
+    # Deleting records
+    orders.delete(43)
+
+    # Atomic batches: written as one log record, rolled back on error
+    with orders.batch():
+        orders.update(42, status="PAID")
+        orders.delete(44)
+    orders.apply([("update", 42, {"status": "READY"}), ("set", 45, {"status": "WAIT"})])
+
+    # Change feed: Change(op, key, old, new) for records matching before or after
+    subscription = orders.subscribe(print, status="PAID")
+    orders.unsubscribe(subscription)
+    async for change in orders.changes(status="PAID"):
+        ...
+
+    # Instrumentation: operation counts and latency histograms, bytes written
+    # and replayed, checkpoint and compaction timings. Off by default. A lazy
+    # where() is timed while it is consumed, recorded once exhausted or closed
+    orders = BayDB("orders.json", indexes=["status"], metrics=True)  # or metrics=Metrics()
+    orders.stats()  # {"records": ..., "indexes": {...}, "counters": {...}, "latencies": {...}}
+
+    # Query cache: where() results, pages and counts are kept in an LRU and
+    # reused until a record with the queried index value changes
+    orders = BayDB("orders.json", indexes=[("status", "bitmap")], query_cache_size=256)
+    orders.where(status="PAID")  # computed
+    orders.where(status="PAID")  # from the cache, until a PAID record changes
+
+    # Consistent reads: a view keeps the state of the moment it was taken,
+    # writers copy a record into open views only when they change it
+    with orders.snapshot_view() as view:
+        for order in view.range("create_time", reverse=True):
+            ...
+        view.where(status="PAID"), view.count(status="PAID"), view.aggregate("items", "PAID"), view.archived(status="DONE")
+
+    # Tiering: move finished records to a cold segment (orders.json.cold),
+    # out of memory and indexes. get() and update() still find them
+    orders.archive(status__in=["DONE", "CANCELED"], create_time__lt=time.time() - 180 * 86400)
+    orders.get(7)  # read from the cold segment, update(7, ...) moves it back
+    list(orders.archived(user_id=15))  # full scan of the cold segment
+
+    # Binary log: checksummed length-prefixed frames with a dictionary of key
+    # names, smaller than JSON lines. The format of an existing file is detected.
+    # A damaged frame is skipped up to the next one whose checksum holds, a torn
+    # tail is cut off on open and kept in orders.bin.torn
+    orders = BayDB("orders.bin", indexes=["status"], log_format=LOG_BINARY)
+    convert_log("orders.json", "orders.bin", LOG_BINARY)  # and back with LOG_JSON
+
+    # Database compaction (reduces file size)
+    orders.compact()
+
+    # Automatic background compaction once half of the log is garbage
+    orders = BayDB("orders.json", indexes=["status"], compact_ratio=0.5, compact_min_records=1000)
+
+    # Group commit: writes are batched by a background thread
+    orders = BayDB("orders.json", indexes=["status"], durability=DURABILITY_GROUP)
+    orders.flush()  # write everything acknowledged so far
+    orders.close()  # flush and release the file
+
+    # Checkpoints: startup loads the newest checkpoint and replays only the log tail
+    orders = BayDB("orders.json", indexes=["status"], checkpoint_every=1000)
+    orders.checkpoint()  # can also be called explicitly, close() makes one too
+
+    # Schema mode: declared top-level fields are stored in compact rows and
+    # short strings are interned, records still read like mappings
+    orders = BayDB("orders.json", indexes=["status"], schema=["user_id", "status", "create_time", "order"])
+
+    # Lazy mode: only offsets and indexed fields stay in memory, records are
+    # decoded from the memory-mapped log on demand
+    orders = BayDB("orders.json", indexes=["status"], lazy=True, cache_size=1024)
+
+    # One writer per file is enforced with a lock, other processes can open
+    # read-only replicas that tail the log on reads
+    replica = BayDB("orders.json", indexes=["status"], readonly=True, refresh_interval=0.01)
+    replica.refresh()  # or explicitly
+
+    # Sharding: records are spread over orders.json.0 .. orders.json.3 by user_id,
+    # keys and unique indexes stay global, queries run over all shards
+    orders = ShardedBayDB("orders.json", 4, indexes=["status"], shard_by="user_id")
+    orders.append({"user_id": 7, "status": "WAIT"})
+    user_orders = orders.where(user_id=7)  # only reads the shard of user 7
+
+    # Asyncio facade: reads are served from memory, writes are awaited until
+    # the writer thread has committed them
+    orders = AsyncBayDB("orders.json", indexes=["status"])
+    order = await orders.update(42, status="PAID")
+    order = orders.get(42)
+    await orders.close()
+"""
+
+
+import argparse
+import asyncio
+import atexit
+import base64
+import bisect
+import glob
+import heapq
+import itertools
+import json
+import marshal
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import errno
+import functools
+import io
+import mmap
+import operator
+import struct
+import os
+import sys
+import zlib
+import threading
+import time
+import traceback
+import types
+import weakref
+
+try:
+    import fcntl
+except ImportError:  # no advisory locks on this platform
+    fcntl = None
+
+
+DURABILITY_FLUSH = "flush"              # write and flush every operation
+DURABILITY_GROUP = "group"              # group commit from a background thread
+DURABILITY_GROUP_FSYNC = "group+fsync"  # group commit followed by fsync
+DURABILITY_MODES = (DURABILITY_FLUSH, DURABILITY_GROUP, DURABILITY_GROUP_FSYNC)
+
+WHERE_OPS = ("eq", "ne", "in", "lt", "le", "gt", "ge", "exists")
+RANGE_OPS = ("lt", "le", "gt", "ge")
+
+INDEX_HASH = "hash"
+INDEX_SORTED = "sorted"
+INDEX_BITMAP = "bitmap"
+INDEX_KINDS = (INDEX_HASH, INDEX_SORTED, INDEX_BITMAP)
+
+AGGREGATE_COUNT = "count"
+AGGREGATE_SUM = "sum"
+AGGREGATE_COUNTERS = "counters"
+AGGREGATE_KINDS = (AGGREGATE_COUNT, AGGREGATE_SUM, AGGREGATE_COUNTERS)
+
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)  # seconds
+INSTRUMENTED_OPERATIONS = ("get", "set", "append", "update", "delete", "apply", "where", "count",
+                           "checkpoint", "compact", "refresh", "flush")
+
+LOG_JSON = "json"
+LOG_BINARY = "binary"
+LOG_FORMATS = (LOG_JSON, LOG_BINARY)
+BINARY_MAGIC = b"\0BAYDB\x02\n"
+MARSHAL_VERSION = 4  # readable by every Python 3.4+
+
+INTERN_MAX_LENGTH = 64  # longer strings in schema mode are unlikely to repeat
+
+CHECKPOINT_VERSION = 2  # 2: aggregates group by dotted paths
+CHECKPOINT_TAIL_CHECK = 4096  # bytes of log before the checkpoint offset covered by its checksum
+
+
+class _LogWriter:
+    """
+    Appends encoded records to the log file. In group modes records are
+    collected for up to commit_window seconds or commit_batch records and
+    written together by a background thread.
+    """
+
+    def __init__(self, filename, durability=DURABILITY_FLUSH, commit_window=0.005, commit_batch=256):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+
+        self.durability = durability
+        self.commit_window = commit_window
+        self.commit_batch = commit_batch
+
+        self._file = open(filename, "ab")
+        self.offset = self._file.tell()   # end of the log including pending records
+        self.written = self.offset        # end of the log already handed to the OS
+        self._pending = []
+        self._closed = False
+        self._waiters = []                # heap of (offset, seq, callback)
+        self._waiter_seq = itertools.count()
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+        self._thread = None
+        if durability != DURABILITY_FLUSH:
+            self._thread = threading.Thread(target=self._run, name=f"baydb-writer:{filename}", daemon=True)
+            self._thread.start()
+            atexit.register(_close_writer, weakref.ref(self))
+
+
+    def write(self, data: bytes) -> int:
+        with self._lock:
+            if self._closed:
+                raise ValueError("Write to closed database")
+
+            offset = self.offset
+            self.offset += len(data)
+            if self._thread is None:
+                self._file.write(data)
+                self._file.flush()
+                self.written = self.offset
+            else:
+                self._pending.append(data)
+                if len(self._pending) == 1 or len(self._pending) >= self.commit_batch:
+                    self._cond.notify_all()
+            return offset
+
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+                deadline = time.monotonic() + self.commit_window
+                while len(self._pending) < self.commit_batch and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+            self._commit()
+
+
+    def _commit(self):
+        with self._io_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                data = b"".join(self._pending)
+                end = self.offset
+                self._pending.clear()
+
+            self._file.write(data)
+            self._file.flush()
+            if self.durability == DURABILITY_GROUP_FSYNC:
+                os.fsync(self._file.fileno())
+
+            with self._lock:
+                self.written = end
+                self._cond.notify_all()
+                ready = self._pop_waiters(end)
+            for callback in ready:
+                callback()
+
+
+    def _pop_waiters(self, offset):
+        ready = []
+        while self._waiters and self._waiters[0][0] <= offset:
+            ready.append(heapq.heappop(self._waiters)[2])
+        return ready
+
+
+    def notify_written(self, offset, callback):
+        with self._lock:
+            if self.written < offset:
+                heapq.heappush(self._waiters, (offset, next(self._waiter_seq), callback))
+                return
+        callback()
+
+
+    def flush(self):
+        self._commit()
+        if self.durability == DURABILITY_GROUP_FSYNC:
+            with self._io_lock:
+                os.fsync(self._file.fileno())
+
+
+    def swap(self, filename, new_file, base):
+        """
+        Appends everything written after offset base to new_file and puts
+        it in place of the log. Returns the offset of the copied tail in
+        the new log and the tail itself.
+        """
+        with self._io_lock, self._lock:
+            if self._pending:
+                self._file.write(b"".join(self._pending))
+                self._pending.clear()
+            self._file.flush()
+
+            with open(filename, "rb") as old, open(new_file, "ab") as new:
+                old.seek(base)
+                tail = old.read()
+                tail_start = new.tell()
+                new.write(tail)
+                new.flush()
+                os.fsync(new.fileno())
+
+            os.replace(new_file, filename)
+            self._file.close()
+            self._file = open(filename, "ab")
+            self.offset = self.written = self._file.tell()
+            self._cond.notify_all()
+            ready = [callback for _, _, callback in self._waiters]
+            self._waiters.clear()
+
+        for callback in ready:
+            callback()
+        return tail_start, tail
+
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._commit()
+        self._file.close()
+
+        with self._lock:
+            ready = [callback for _, _, callback in self._waiters]
+            self._waiters.clear()
+        for callback in ready:
+            callback()
+
+
+def _close_writer(writer_ref):
+    writer = writer_ref()
+    if writer is not None:
+        writer.close()
+
+
+class _HashIndex(collections.defaultdict):
+    kind = INDEX_HASH
+
+    def __init__(self):
+        super().__init__(set)
+
+
+    def add(self, value, key):
+        self[value].add(key)
+
+
+    def discard(self, value, key):
+        keys = self.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self[value]
+
+
+    def lookup(self, value):
+        return self.get(value, ())
+
+
+    def lookup_any(self, values):
+        return set().union(*(self.lookup(value) for value in values))
+
+
+    def estimate(self, op, value):
+        if op == "eq":
+            return len(self.lookup(value))
+        if op == "in":
+            return sum(len(self.lookup(v)) for v in value)
+        return None
+
+
+    def select(self, op, value):
+        return self.lookup(value) if op == "eq" else self.lookup_any(value)
+
+
+    def distinct(self):
+        return self.keys()
+
+
+    def dump(self):
+        return [[value, list(keys)] for value, keys in self.items() if keys]
+
+
+    def load(self, pairs):
+        for value, keys in pairs:
+            self[value] = set(keys)
+
+
+class _SortedIndex:
+    """
+    Index over (value, key) pairs kept in a sorted list. Values must be
+    mutually comparable, records without the field sort first.
+    """
+
+    kind = INDEX_SORTED
+
+    def __init__(self):
+        self._items = []
+        self._missing = set()
+
+
+    def __len__(self):
+        return len(self._items) + len(self._missing)
+
+
+    def add(self, value, key):
+        if value is None:
+            self._missing.add(key)
+        else:
+            bisect.insort(self._items, (value, key))
+
+
+    def check(self, value, key):
+        """Raises TypeError where add() would, without changing the index."""
+        if value is not None:
+            bisect.bisect_right(self._items, (value, key))
+
+
+    def discard(self, value, key):
+        if value is None:
+            self._missing.discard(key)
+            return
+
+        pos = bisect.bisect_left(self._items, (value, key))
+        if pos < len(self._items) and self._items[pos] == (value, key):
+            del self._items[pos]
+
+
+    def lookup(self, value):
+        if value is None:
+            return self._missing
+        return set(self.range(value, value, inclusive=True))
+
+
+    def lookup_any(self, values):
+        return set().union(*(self.lookup(value) for value in values))
+
+
+    def _bounds(self, op, value):
+        first = operator.itemgetter(0)
+        if op in ("lt", "ge"):
+            pos = bisect.bisect_left(self._items, value, key=first)
+        else:
+            pos = bisect.bisect_right(self._items, value, key=first)
+        return (0, pos) if op in ("lt", "le") else (pos, len(self._items))
+
+
+    def estimate(self, op, value):
+        try:
+            if op in ("eq", "in"):
+                total = 0
+                for v in ([value] if op == "eq" else value):
+                    if v is None:
+                        total += len(self._missing)
+                    else:
+                        start, _ = self._bounds("ge", v)
+                        _, stop = self._bounds("le", v)
+                        total += stop - start
+                return total
+            if op in RANGE_OPS:
+                start, stop = self._bounds(op, value)
+                return stop - start
+        except TypeError:
+            pass  # not comparable with the indexed values, leave it to the filter
+        return None
+
+
+    def select(self, op, value):
+        if op == "eq":
+            return self.lookup(value)
+        if op == "in":
+            return self.lookup_any(value)
+        start, stop = self._bounds(op, value)
+        return {key for _, key in self._items[start:stop]}
+
+
+    def distinct(self):
+        values = [None] if self._missing else []
+        for value, _ in self._items:
+            if not values or values[-1] != value:
+                values.append(value)
+        return values
+
+
+    def range(self, lo=None, hi=None, reverse=False, inclusive=False):
+        start = 0 if lo is None else bisect.bisect_left(self._items, (lo,))
+        if hi is None:
+            stop = len(self._items)
+        elif inclusive:
+            stop = start
+            while stop < len(self._items) and self._items[stop][0] == hi:
+                stop += 1
+        else:
+            stop = bisect.bisect_left(self._items, (hi,))
+
+        missing = sorted(self._missing) if lo is None else []
+        if reverse:
+            for pos in range(stop - 1, start - 1, -1):
+                yield self._items[pos][1]
+            yield from reversed(missing)
+        else:
+            yield from missing
+            for pos in range(start, stop):
+                yield self._items[pos][1]
+
+
+    def range_after(self, position=None, reverse=False):
+        """
+        Keys in (value, key) order, or reversed, strictly after position,
+        a (has_value, value, key) tuple from a page cursor.
+        """
+        missing = sorted(self._missing)
+        start, stop = 0, len(self._items)
+        if position is not None:
+            has_value, value, key = position
+            if not has_value and not reverse:
+                missing = missing[bisect.bisect_right(missing, key):]
+            elif not has_value:
+                missing, stop = missing[:bisect.bisect_left(missing, key)], 0
+            elif not reverse:
+                missing, start = [], bisect.bisect_right(self._items, (value, key))
+            else:
+                stop = bisect.bisect_left(self._items, (value, key))
+
+        if reverse:
+            for pos in range(stop - 1, start - 1, -1):
+                yield self._items[pos][1]
+            yield from reversed(missing)
+        else:
+            yield from missing
+            for pos in range(start, stop):
+                yield self._items[pos][1]
+
+
+    def dump(self):
+        return [[None, sorted(self._missing)]] + [[value, [key]] for value, key in self._items]
+
+
+    def load(self, pairs):
+        for value, keys in pairs:
+            for key in keys:
+                if value is None:
+                    self._missing.add(key)
+                else:
+                    self._items.append((value, key))
+        self._items.sort()
+
+
+class _Bits:
+    """
+    Immutable set of non-negative keys stored as a little-endian bitset.
+    Combines with &, | and - as whole-integer operations.
+    """
+
+    __slots__ = ("_data", "_count")
+
+    def __init__(self, data=b"", count=None):
+        self._data = data
+        self._count = count
+
+
+    @classmethod
+    def from_int(cls, bits):
+        return cls(bits.to_bytes((bits.bit_length() + 7) // 8, "little"))
+
+
+    def to_int(self):
+        return int.from_bytes(self._data, "little")
+
+
+    def __contains__(self, key):
+        pos = key >> 3
+        return 0 <= pos < len(self._data) and bool(self._data[pos] >> (key & 7) & 1)
+
+
+    def __len__(self):
+        if self._count is None:
+            self._count = self.to_int().bit_count()
+        return self._count
+
+
+    def __iter__(self):
+        for pos, byte in enumerate(self._data):
+            if byte:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield pos * 8 + bit
+
+
+    def __and__(self, other):
+        return _Bits.from_int(self.to_int() & other.to_int())
+
+
+    def __or__(self, other):
+        return _Bits.from_int(self.to_int() | other.to_int())
+
+
+    def __sub__(self, other):
+        return _Bits.from_int(self.to_int() & ~other.to_int())
+
+
+class _BitmapIndex(dict):
+    """
+    Index for fields with a handful of values: a bitset of keys per value.
+    Keys must be non-negative. Lookups return _Bits, so conditions over
+    several bitmap indexes are combined with integer operations.
+    """
+
+    kind = INDEX_BITMAP
+
+    def __init__(self):
+        super().__init__()
+        self._counts = {}
+
+
+    def add(self, value, key):
+        if key < 0:
+            raise ValueError(f"Bitmap index can't hold negative key {key}")
+        data = self.get(value)
+        if data is None:
+            data = self[value] = bytearray()
+        pos = key >> 3
+        if pos >= len(data):
+            data.extend(bytes(pos + 1 - len(data)))
+        if not data[pos] >> (key & 7) & 1:
+            data[pos] |= 1 << (key & 7)
+            self._counts[value] = self._counts.get(value, 0) + 1
+
+
+    def discard(self, value, key):
+        data = self.get(value)
+        pos = key >> 3
+        if data is None or key < 0 or pos >= len(data) or not data[pos] >> (key & 7) & 1:
+            return
+
+        data[pos] &= ~(1 << (key & 7))
+        self._counts[value] -= 1
+        if not self._counts[value]:
+            del self[value], self._counts[value]
+
+
+    def lookup(self, value):
+        data = self.get(value)
+        if data is None:
+            return _Bits()
+        return _Bits(bytes(data).rstrip(b"\0"), self._counts[value])
+
+
+    def lookup_any(self, values):
+        bits = 0
+        for value in values:
+            data = self.get(value)
+            if data is not None:
+                bits |= int.from_bytes(data, "little")
+        return _Bits.from_int(bits)
+
+
+    def lookup_except(self, value):
+        return self.lookup_any(v for v in self if v != value)
+
+
+    def count(self, value):
+        return self._counts.get(value, 0)
+
+
+    def estimate(self, op, value):
+        if op == "eq":
+            return self.count(value)
+        if op == "in":
+            return sum(self.count(v) for v in value)
+        if op == "ne":
+            return sum(self._counts.values()) - self.count(value)
+        return None
+
+
+    def select(self, op, value):
+        if op == "eq":
+            return self.lookup(value)
+        if op == "in":
+            return self.lookup_any(value)
+        return self.lookup_except(value)
+
+
+    def distinct(self):
+        return self.keys()
+
+
+    def dump(self):
+        return [[value, list(self.lookup(value))] for value in self]
+
+
+    def load(self, pairs):
+        for value, keys in pairs:
+            for key in keys:
+                self.add(value, key)
+
+
+INDEX_CLASSES = {INDEX_HASH: _HashIndex, INDEX_SORTED: _SortedIndex, INDEX_BITMAP: _BitmapIndex}
+
+
+class _Field:
+    """
+    Reads an indexed field from a record: a top-level key, a dotted path
+    into nested dicts, or the result of a key function. Missing parts and
+    key functions failing on a record give None.
+    """
+
+    __slots__ = ("root", "_parts", "_function")
+
+    def __init__(self, path, function=None):
+        self.root = None if function is not None else path.split(".")[0]
+        self._parts = path.split(".")
+        self._function = function
+
+
+    def __call__(self, value):
+        if self._function is not None:
+            try:
+                return self._function(value)
+            except (LookupError, TypeError, AttributeError, ValueError):
+                return None
+
+        for part in self._parts:
+            if not isinstance(value, collections.abc.Mapping):
+                return None
+            value = value.get(part)
+        return value
+
+
+    def affected_by(self, kv):
+        return self.root is None or self.root in kv
+
+
+    def is_plain(self):
+        return self._function is None and len(self._parts) == 1
+
+
+    def is_function(self):
+        return self._function is not None
+
+
+class _Aggregate:
+    """
+    Running total over all records, optionally grouped by a field: count of
+    records, sum of a numeric field, or item-wise sum of a dict of numbers.
+    Fields and the group field can be dotted paths into nested dicts.
+    """
+
+    def __init__(self, kind, field=None, group_by=None):
+        if kind not in AGGREGATE_KINDS:
+            raise ValueError(f"Unknown aggregate kind {kind!r}")
+        if kind != AGGREGATE_COUNT and field is None:
+            raise ValueError(f"Aggregate {kind} needs a field")
+
+        self.kind = kind
+        self.field = field
+        self.group_by = group_by
+        self._value = _Field(field) if field is not None else None
+        self._group = _Field(group_by) if group_by is not None else None
+        self._counts = {}
+        self._totals = {}
+
+
+    def spec(self):
+        return [self.kind, self.field, self.group_by]
+
+
+    @staticmethod
+    def _is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+    def add(self, record, sign=1):
+        group = self._group(record) if self._group is not None else None
+        count = self._counts.get(group, 0) + sign
+        if not count:
+            del self._counts[group]
+            self._totals.pop(group, None)
+            return
+        self._counts[group] = count
+
+        if self.kind == AGGREGATE_SUM:
+            value = self._value(record)
+            if self._is_number(value):
+                self._totals[group] = self._totals.get(group, 0) + sign * value
+        elif self.kind == AGGREGATE_COUNTERS:
+            value = self._value(record)
+            if isinstance(value, dict):
+                counters = self._totals.setdefault(group, {})
+                for item, number in value.items():
+                    if self._is_number(number):
+                        total = counters.get(item, 0) + sign * number
+                        if total:
+                            counters[item] = total
+                        else:
+                            counters.pop(item, None)
+
+
+    def discard(self, record):
+        self.add(record, -1)
+
+
+    def total(self, group):
+        if self.kind == AGGREGATE_COUNT:
+            return self._counts.get(group, 0)
+        if self.kind == AGGREGATE_SUM:
+            return self._totals.get(group, 0)
+        return dict(self._totals.get(group, {}))
+
+
+    def groups(self):
+        return {group: self.total(group) for group in self._counts}
+
+
+    def dump(self):
+        # counters are changed in place by add(), a checkpoint written on another thread needs its own copy
+        if self.kind == AGGREGATE_COUNTERS:
+            return [[group, count, dict(self._totals[group]) if group in self._totals else None]
+                    for group, count in self._counts.items()]
+        return [[group, count, self._totals.get(group)] for group, count in self._counts.items()]
+
+
+    def load(self, rows):
+        for group, count, total in rows:
+            self._counts[group] = count
+            if total is not None:
+                self._totals[group] = total
+
+
+class Record(collections.abc.Mapping):
+    """
+    Read-only view of a stored record with its key exposed as "id".
+    The stored value is replaced, never modified, on update, so a view
+    keeps showing the record as it was when it was fetched.
+    """
+
+    __slots__ = ("id", "_value")
+
+    def __init__(self, key, value):
+        self.id = key
+        self._value = value
+
+
+    def __getitem__(self, name):
+        if name == "id":
+            return self.id
+        return self._value[name]
+
+
+    def get(self, name, default=None):
+        if name == "id":
+            return self.id
+        return self._value.get(name, default)
+
+
+    def __contains__(self, name):
+        return name == "id" or name in self._value
+
+
+    def __iter__(self):
+        yield "id"
+        yield from self._value
+
+
+    def __len__(self):
+        return len(self._value) + 1
+
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+    def __or__(self, other):
+        return self.copy() | dict(other)
+
+
+    def __ror__(self, other):
+        return dict(other) | self.copy()
+
+
+    def copy(self) -> dict:
+        return {"id": self.id} | self._value
+
+
+class _Records(dict):
+    def __init__(self, fields):
+        super().__init__()
+        self._fields = fields
+
+
+    def field(self, key, name):
+        value = self.get(key)
+        return None if value is None else self._fields[name](value)
+
+
+    def merge(self, key, kv):
+        self[key] = self[key] | kv  # replaced, not modified: Record and snapshot views hold the old one
+
+
+    def save_entry(self, key):
+        return self.get(key, _MISSING)
+
+
+    def restore_entry(self, key, entry):
+        if entry is _MISSING:
+            self.pop(key, None)
+        else:
+            self[key] = entry
+
+
+class _Schema:
+    """
+    Positions of the declared top-level fields of schema-mode rows.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(sys.intern(field) for field in fields)
+        self.positions = {field: pos for pos, field in enumerate(self.fields)}
+
+
+def _compact_value(value):
+    if isinstance(value, str):
+        return sys.intern(value) if len(value) <= INTERN_MAX_LENGTH else value
+    if isinstance(value, dict):
+        return {sys.intern(k) if isinstance(k, str) else k: _compact_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_compact_value(v) for v in value]
+    return value
+
+
+class _Row(collections.abc.Mapping):
+    """
+    Stored record in schema mode: declared fields in a tuple, anything else
+    in a small dict. Strings are interned, so repeated statuses, nicks and
+    item names are shared between records.
+    """
+
+    __slots__ = ("_schema", "_values", "_extra")
+
+    def __init__(self, schema, value):
+        self._schema = schema
+        self._values = tuple(_compact_value(value[field]) if field in value else _MISSING
+                             for field in schema.fields)
+        extra = {sys.intern(k): _compact_value(v) for k, v in value.items() if k not in schema.positions}
+        self._extra = extra or None
+
+
+    def __getitem__(self, name):
+        pos = self._schema.positions.get(name)
+        if pos is not None:
+            value = self._values[pos]
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and name in self._extra:
+            return self._extra[name]
+        raise KeyError(name)
+
+
+    def get(self, name, default=None):
+        pos = self._schema.positions.get(name)
+        if pos is not None:
+            value = self._values[pos]
+            return default if value is _MISSING else value
+        if self._extra is not None:
+            return self._extra.get(name, default)
+        return default
+
+
+    def __iter__(self):
+        for field, value in zip(self._schema.fields, self._values):
+            if value is not _MISSING:
+                yield field
+        if self._extra is not None:
+            yield from self._extra
+
+
+    def __len__(self):
+        return sum(value is not _MISSING for value in self._values) + len(self._extra or ())
+
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+    def __or__(self, other):
+        return dict(self) | dict(other)
+
+
+    def __ror__(self, other):
+        return dict(other) | dict(self)
+
+
+    def copy(self) -> dict:
+        return dict(self)
+
+
+def _plain(value):
+    if isinstance(value, _Row):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class _SchemaRecords(_Records):
+    def __init__(self, fields, schema):
+        super().__init__(fields)
+        self._schema = schema
+
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, _Row):
+            value = _Row(self._schema, value)
+        super().__setitem__(key, value)
+
+
+_MISSING = object()
+
+Change = collections.namedtuple("Change", ["op", "key", "old", "new"])
+Page = collections.namedtuple("Page", ["records", "cursor"])
+
+
+class Metrics:
+    """
+    Counters and latency histograms collected by BayDB(metrics=...). Any
+    object with the same count() and observe() methods can be passed
+    instead, e.g. an adapter to an external monitoring system.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._counters = collections.defaultdict(int)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                                      "buckets": [0] * (len(self._buckets) + 1)}
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["buckets"][bisect.bisect_left(self._buckets, seconds)] += 1
+
+
+    def snapshot(self):
+        with self._lock:
+            latencies = {}
+            for name, histogram in self._histograms.items():
+                bounds = [str(bound) for bound in self._buckets] + ["+Inf"]
+                latencies[name] = histogram | {"buckets": dict(zip(bounds, histogram["buckets"]))}
+            return {"counters": dict(self._counters), "latencies": latencies}
+
+
+def _ordered(compare):
+    def test(actual, value):
+        try:
+            return actual is not None and compare(actual, value)
+        except TypeError:
+            return False
+    return test
+
+
+def _contained(actual, values):
+    try:
+        return actual in values
+    except TypeError:
+        return False  # an unhashable value, e.g. a list, is in no set of values
+
+
+_TESTS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "in": _contained,
+    "lt": _ordered(operator.lt),
+    "le": _ordered(operator.le),
+    "gt": _ordered(operator.gt),
+    "ge": _ordered(operator.ge),
+    "exists": lambda actual, value: (actual is not None) == bool(value),
+}
+
+
+def _order_field(order_by):
+    if order_by is not None and order_by.startswith("-"):
+        return order_by[1:], True
+    return order_by, False
+
+
+def _encode_cursor(position):
+    data = json.dumps([position[0]] if len(position) == 1 else list(position[1:]),
+                      ensure_ascii=False, separators=(",", ":")).encode("utf8")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _decode_cursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError(f"Bad cursor {cursor!r}") from None
+    if len(position) == 1:
+        return (position[0],)
+    value, key = position
+    return (value is not None, value, key)
+
+
+def _log_entries(obj):
+    if obj[0] == "batch":
+        return obj[2]
+    return [obj]
+
+
+def _decode_entries(read, key, locator, decode=json.loads):
+    value = {}
+    for pos in range(0, len(locator), 2):
+        for action, entry_key, kv in _log_entries(decode(read(locator[pos], locator[pos + 1]))):
+            if entry_key != key:
+                continue
+            if action == "set":
+                value = kv
+            kv.pop("id", None)
+            if action == "update":
+                value.update(kv)
+    return value
+
+
+class _JsonCodec:
+    """
+    The original log format: one JSON array per line.
+    """
+
+    format = LOG_JSON
+
+    def encode(self, entry):
+        """Returns (prefix, record): bytes to append before the record, and the record itself."""
+        return b"", (json.dumps(entry, ensure_ascii=False, default=_plain) + "\n").encode("utf8")
+
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+    def scan(self, f, offset):
+        """Yields (offset, length, data, complete) for every record from offset on."""
+        f.seek(offset)
+        for line in f:
+            yield offset, len(line), line, line.endswith(b"\n")
+            offset += len(line)
+
+
+    def count(self, data):
+        return data.count(b"\n")
+
+
+    def header(self):
+        return b""
+
+
+    def frozen(self):
+        return self
+
+
+    def state(self):
+        return None
+
+
+    def load_state(self, state):
+        return True
+
+
+class _BinaryCodec:
+    """
+    Binary log format: a magic header, then frames of a little-endian
+    uint32 payload length, uint32 crc32 of the payload and the payload.
+    Record payloads are b"R", uint32 size of the key dictionary, uint32
+    crc32 of the marshalled entry and raw deflate of it primed with that
+    dictionary (zdict), so repeated key names cost a couple of bytes and
+    decoding stays in C. Key names are added to the dictionary by b"K"
+    frames written just before the first record using them, so a log is
+    readable from its start or from a checkpoint that saved the
+    dictionary, and old records stay readable as it grows.
+
+    A key frame carries the number of names and dictionary bytes before
+    its own. Names of a damaged one are lost: their bytes are zero-filled
+    and stored as their length, later names keep their places, and only
+    records that referenced lost bytes fail the entry checksum.
+    """
+
+    format = LOG_BINARY
+    _frame = struct.Struct("<II")
+    _keys_head = struct.Struct("<II")    # names before these, dictionary bytes before these
+    _record_head = struct.Struct("<II")  # names in the dictionary, crc32 of the entry
+    _KEYS = b"K"
+    _RECORD = b"R"
+    _SCALARS = {str, int, float, bool, type(None)}
+    _WBITS = -15  # raw deflate, the frame has its own checksum
+    _ZDICT_SIZE = 32 * 1024  # deflate only looks this far back
+
+    def __init__(self, names=(), frozen=False):
+        self._names = []               # byte length instead of a lost name
+        self._known = set()
+        self._joined = bytearray()
+        self._ends = [0]
+        self._frozen = frozen
+        self._extend(names)
+        self.end = 0
+
+
+    def _pack_frame(self, payload):
+        return self._frame.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+    def _pack(self, value, new):
+        kind = type(value)
+        if kind in self._SCALARS:
+            return value
+        if kind is dict or isinstance(value, collections.abc.Mapping):
+            packed = {}
+            for name, item in value.items():
+                if type(name) is not str:
+                    # same key as the JSON format would store
+                    name = str(name) if isinstance(name, str) else json.dumps(name)
+                if name not in self._known and not self._frozen:
+                    self._known.add(name)
+                    new.append(name)
+                packed[name] = self._pack(item, new)
+            return packed
+        if kind is list or isinstance(value, (list, tuple)):
+            return [self._pack(item, new) for item in value]
+        for scalar in (bool, int, float, str):
+            if isinstance(value, scalar):
+                return scalar(value)  # e.g. an enum member, marshal only takes exact types
+        raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+    def _pack_entry(self, entry, new):
+        action, key, payload = entry
+        if action == "batch":
+            return action, key, [self._pack_entry(item, new) for item in payload]
+        return action, key, self._pack(payload, new)
+
+
+    def encode(self, entry):
+        new = []
+        data = marshal.dumps(self._pack_entry(entry, new), MARSHAL_VERSION)
+        prefix = b""
+        if new:
+            prefix = self._pack_keys(len(self._names), new)
+            self._extend(new)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, self._WBITS,
+                                      zdict=self._zdict(len(self._names)))
+        return prefix, self._pack_frame(self._RECORD + self._record_head.pack(len(self._names), zlib.crc32(data))
+                                        + compressor.compress(data) + compressor.flush())
+
+
+    def _pack_keys(self, start, names):
+        return self._pack_frame(self._KEYS + self._keys_head.pack(start, self._ends[start])
+                                + marshal.dumps(names, MARSHAL_VERSION))
+
+
+    def decode(self, data):
+        if len(data) < self._frame.size:
+            raise ValueError("Bad frame checksum")
+        length, crc = self._frame.unpack_from(data)
+        payload = memoryview(data)[self._frame.size:]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise ValueError("Bad frame checksum")
+        if payload[:1] != self._RECORD:
+            raise ValueError("Not a record frame")
+        names_used, crc = self._record_head.unpack_from(payload, 1)
+        if names_used > len(self._names):
+            raise ValueError("Record uses unknown key names")
+        decompressor = zlib.decompressobj(self._WBITS, zdict=self._zdict(names_used))
+        try:
+            data = decompressor.decompress(payload[1 + self._record_head.size:])
+        except zlib.error as e:
+            raise ValueError(f"Bad record: {e}") from None
+        if zlib.crc32(data) != crc:
+            raise ValueError("Record uses key names lost with a damaged frame")
+        return marshal.loads(data)
+
+
+    def scan(self, f, offset):
+        """Like _JsonCodec.scan, key frames are consumed. self.end is the end of the last whole frame."""
+        f.seek(offset)
+        self.end = offset
+        if offset == 0:
+            magic = f.read(len(BINARY_MAGIC))
+            if not magic:
+                return
+            if magic != BINARY_MAGIC:
+                raise ValueError("Not a binary BayDB log")
+            offset = self.end = len(BINARY_MAGIC)
+
+        while True:
+            frame = f.read(self._frame.size)
+            if not frame:
+                return
+            if len(frame) == self._frame.size:
+                length, crc = self._frame.unpack(frame)
+                frame += f.read(length)
+                if len(frame) == self._frame.size + length and zlib.crc32(frame[self._frame.size:]) == crc:
+                    if frame[self._frame.size:self._frame.size + 1] == self._KEYS:
+                        start, joined = self._keys_head.unpack_from(frame, self._frame.size + 1)
+                        self._extend(marshal.loads(frame[self._frame.size + 1 + self._keys_head.size:]),
+                                     start, joined)
+                    else:
+                        yield offset, len(frame), frame, True
+                    offset = self.end = offset + len(frame)
+                    continue
+
+            # a damaged length can point anywhere, so carry on from the next frame that checks out
+            f.seek(offset)
+            rest = f.read()
+            skip = self._resync(rest)
+            if skip is None:
+                yield offset, len(rest), rest, False  # torn tail
+                return
+            yield offset, skip, rest[:skip], True  # reported by decode as a bad frame
+            offset = self.end = offset + skip
+            f.seek(offset)
+
+
+    def _resync(self, data):
+        """Position of the first frame after the start of data whose checksum holds, None without one."""
+        size = self._frame.size
+        markers = (self._KEYS[0], self._RECORD[0])
+        for pos in range(1, len(data) - size):
+            if data[pos + size] not in markers:
+                continue
+            length, crc = self._frame.unpack_from(data, pos)
+            end = pos + size + length
+            if end <= len(data) and zlib.crc32(memoryview(data)[pos + size:end]) == crc:
+                return pos
+        return None
+
+
+    def _extend(self, names, start=None, joined=None):
+        names = list(names)
+        if start is not None and start < len(self._names):
+            names = names[len(self._names) - start:]
+        elif start is not None and start > len(self._names):
+            # skipped over a damaged key frame, the next names still go where the writer put them
+            lost = [max(joined - len(self._joined), 0)] + [0] * (start - len(self._names) - 1)
+            names = lost + names
+
+        for name in names:
+            if isinstance(name, int):
+                self._joined += bytes(name)
+            else:
+                self._known.add(name)
+                self._joined += name.encode("utf8")
+            self._names.append(name)
+            self._ends.append(len(self._joined))
+
+
+    def _zdict(self, names_used):
+        # the most recent names are the cheapest to reference
+        end = self._ends[names_used]
+        return bytes(self._joined[max(0, end - self._ZDICT_SIZE):end])
+
+
+    def count(self, data):
+        count = 0
+        view = memoryview(data)
+        pos = 0
+        while pos + self._frame.size <= len(view):
+            length, _ = self._frame.unpack_from(view, pos)
+            count += view[pos + self._frame.size:pos + self._frame.size + 1] == self._RECORD
+            pos += self._frame.size + length
+        return count
+
+
+    def header(self):
+        return BINARY_MAGIC + self._pack_keys(0, self._names)
+
+
+    def frozen(self):
+        return _BinaryCodec(self._names, frozen=True)
+
+
+    def state(self):
+        return list(self._names)
+
+
+    def load_state(self, state):
+        if state is None:
+            return False
+        self.__init__(state)
+        return True
+
+
+LOG_CODECS = {LOG_JSON: _JsonCodec, LOG_BINARY: _BinaryCodec}
+
+
+def _detect_log_format(filename, log_format=None):
+    try:
+        with open(filename, "rb") as f:
+            start = f.read(len(BINARY_MAGIC))
+    except FileNotFoundError:
+        start = b""
+
+    if not start:
+        found = log_format or LOG_JSON
+    else:
+        found = LOG_BINARY if start == BINARY_MAGIC else LOG_JSON
+        if found == LOG_JSON and start.startswith(BINARY_MAGIC[:6]):
+            raise ValueError(f"{filename} is a binary log of an unsupported version")
+    if log_format is not None and log_format != found:
+        raise ValueError(f"{filename} is a {found} log, convert it with convert_log() to use {log_format}")
+    if found not in LOG_FORMATS:
+        raise ValueError(f"Unknown log format: {found}")
+    return found
+
+
+def convert_log(source, target, log_format):
+    """
+    Rewrites a log in the given format, entry by entry, keeping the
+    history. The source format is detected. Returns the number of entries.
+    """
+    reader = LOG_CODECS[_detect_log_format(source)]()
+    writer = LOG_CODECS[log_format]()
+    entries = 0
+    with open(source, "rb") as src, open(target + ".tmp", "wb") as dst:
+        if log_format == LOG_BINARY:
+            dst.write(BINARY_MAGIC)
+        for _, _, data, complete in reader.scan(src, 0):
+            if not complete:
+                break
+            prefix, record = writer.encode(reader.decode(data))
+            dst.write(prefix + record)
+            entries += 1
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(target + ".tmp", target)
+    return entries
+
+
+class _ColdSegment:
+    """
+    Archived records: an append-only file in the log format and an index
+    of key -> (offset, length) next to it in filename.idx. Opening reads
+    only the first line of the index (max id, count and the codec state),
+    the rest is loaded on the first lookup.
+    """
+
+    def __init__(self, filename, log_format):
+        self._filename = filename
+        self._index_file = filename + ".idx"
+        self._locations = None
+        self.max_id = -1
+        self.records = 0
+        state = None
+        try:
+            with open(self._index_file, "rb") as f:
+                header = json.loads(f.readline())
+            self.max_id, self.records, state = header["max_id"], header["records"], header["log_keys"]
+        except FileNotFoundError:
+            pass
+
+        if os.path.exists(filename):
+            log_format = _detect_log_format(filename)
+        self._codec = LOG_CODECS[log_format]()
+        self._codec.load_state(state)
+
+
+    def __len__(self):
+        return self.records
+
+
+    def __contains__(self, key):
+        return key <= self.max_id and key in self._load()
+
+
+    def _load(self):
+        if self._locations is None:
+            self._locations = {}
+            try:
+                with open(self._index_file, "rb") as f:
+                    f.readline()
+                    self._locations = {int(key): tuple(location) for key, location in json.loads(f.readline()).items()}
+            except FileNotFoundError:
+                pass
+        return self._locations
+
+
+    def _decode(self, f, location):
+        offset, length = location
+        f.seek(offset)
+        return self._codec.decode(f.read(length))[2]
+
+
+    def get(self, key):
+        if key not in self:
+            return None
+        with open(self._filename, "rb") as f:
+            return self._decode(f, self._locations[key])
+
+
+    def items(self):
+        locations = sorted(self._load().items())
+        if not locations:
+            return
+        with open(self._filename, "rb") as f:
+            for key, location in locations:
+                yield key, self._decode(f, location)
+
+
+    def add(self, records):
+        locations = self._load()
+        with open(self._filename, "ab") as f:
+            if f.tell() == 0:
+                f.write(self._codec.header())
+            for key, value in records:
+                prefix, data = self._codec.encode(["set", key, value])
+                f.write(prefix)
+                locations[key] = (f.tell(), len(data))
+                f.write(data)
+                self.max_id = max(self.max_id, key)
+            f.flush()
+            os.fsync(f.fileno())
+        self._save_index()  # the records become visible only now
+
+
+    def discard(self, key):
+        if key in self:
+            del self._locations[key]
+            self._save_index()
+
+
+    def _save_index(self):
+        self.records = len(self._locations)
+        header = {"max_id": self.max_id, "records": self.records, "log_keys": self._codec.state()}
+        with open(self._index_file + ".tmp", "wb") as f:
+            f.write(json.dumps(header).encode("utf8") + b"\n")
+            f.write(json.dumps(self._locations).encode("utf8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._index_file + ".tmp", self._index_file)
+
+
+class _LazyRecords(collections.abc.MutableMapping):
+    """
+    Records kept as (offset, length) pairs of their log entries, the set
+    followed by later updates. Only indexed fields are held in memory, the
+    rest is decoded from the memory-mapped log and kept in a bounded LRU.
+    """
+
+    def __init__(self, filename, fields, cache_size, sync, decode=json.loads):
+        self._filename = filename
+        self._decode = decode
+        self._names = {name: pos for pos, name in enumerate(fields)}
+        self._getters = list(fields.values())
+        self._derived = [field for field in self._getters if not field.is_plain()]
+        self._cache_size = cache_size
+        self._sync = sync              # makes the log readable up to the given offset
+        self._locators = {}            # key -> (offset, length, offset, length, ...)
+        self._fields = {}              # key -> tuple of indexed field values
+        self._cache = collections.OrderedDict()
+        self._unlocated = {}           # values set in memory but not yet written
+        self._file = None
+        self._mmap = None
+
+
+    def __len__(self):
+        return len(self._fields)
+
+
+    def __iter__(self):
+        return iter(self._fields)
+
+
+    def __contains__(self, key):
+        return key in self._fields
+
+
+    def __getitem__(self, key):
+        if key in self._unlocated:
+            return self._unlocated[key]
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        value = _decode_entries(self._read, key, self._locators[key], self._decode)
+        self._cache_put(key, value)
+        return value
+
+
+    def __setitem__(self, key, value):
+        self._fields[key] = tuple(field(value) for field in self._getters)
+        self._unlocated[key] = value
+        self._cache.pop(key, None)
+
+
+    def __delitem__(self, key):
+        del self._fields[key]
+        self._locators.pop(key, None)
+        self._unlocated.pop(key, None)
+        self._cache.pop(key, None)
+
+
+    def _cache_put(self, key, value):
+        self._cache[key] = value
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+
+    def _read(self, offset, length):
+        end = offset + length
+        if self._mmap is None or len(self._mmap) < end:
+            self._sync(end)
+            self.close()
+            self._file = open(self._filename, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[offset:end]
+
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+
+    def field(self, key, name):
+        fields = self._fields.get(key)
+        return None if fields is None else fields[self._names[name]]
+
+
+    def locate(self, key, action, offset, length):
+        if key not in self._fields:
+            return
+        if action == "set":
+            self._locators[key] = (offset, length)
+        elif self._locators.get(key, (None,))[-2:-1] != (offset,):
+            self._locators[key] = self._locators.get(key, ()) + (offset, length)
+
+        value = self._unlocated.pop(key, None)
+        if value is not None:
+            self._cache_put(key, value)
+
+
+    def replay(self, action, key, kv, offset, length):
+        if action == "set":
+            self._fields[key] = tuple(field(kv) for field in self._getters)
+        elif action == "update" and any(field.affected_by(kv) for field in self._derived):
+            self._fields[key] = tuple(field(self[key] | kv) for field in self._getters)
+        elif action == "update":
+            fields = list(self._fields[key])
+            for name, value in kv.items():
+                if name in self._names:
+                    fields[self._names[name]] = value
+            self._fields[key] = tuple(fields)
+        elif action == "delete" or action == "archive":
+            if key in self:
+                del self[key]
+            return
+        self.locate(key, action, offset, length)
+        self._cache.pop(key, None)
+
+
+    def relocate(self, locations, base=0, shift=0):
+        """
+        Points locators at a rewritten log: entries before base are replaced
+        by the record's location in the rewrite, later ones move by shift.
+        """
+        self.close()
+        for key, locator in self._locators.items():
+            moved = locations[key] if locator[0] < base else ()
+            for pos in range(0, len(locator), 2):
+                if locator[pos] >= base:
+                    moved += (locator[pos] + shift, locator[pos + 1])
+            self._locators[key] = moved
+
+
+    def locators(self):
+        return list(self._locators.items())
+
+
+    def state(self):
+        return [[key, list(self._locators[key]), list(fields)] for key, fields in self._fields.items()]
+
+
+    def load_state(self, state):
+        for key, locator, fields in state:
+            self._locators[key] = tuple(locator)
+            self._fields[key] = tuple(fields)
+
+        # key function values don't survive JSON and the function may have changed since
+        functions = [pos for pos, field in enumerate(self._getters) if field.is_function()]
+        if functions:
+            for key, fields in self._fields.items():
+                value = self[key]
+                fields = list(fields)
+                for pos in functions:
+                    fields[pos] = self._getters[pos](value)
+                self._fields[key] = tuple(fields)
+
+
+    def save_entry(self, key):
+        return self._fields.get(key), self._locators.get(key), self._unlocated.get(key)
+
+
+    def restore_entry(self, key, entry):
+        self._cache.pop(key, None)
+        for store, value in zip((self._fields, self._locators, self._unlocated), entry):
+            if value is None:
+                store.pop(key, None)
+            else:
+                store[key] = value
+
+
+class SnapshotView:
+    """
+    Point-in-time read view returned by BayDB.snapshot_view(). Nothing is
+    copied up front: while the view is open, every change first saves the
+    record's previous value into it. Unchanged records are read from the
+    db, so an open view costs memory only for records changed meanwhile.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._saved = {}       # key -> value at the snapshot, _MISSING if it wasn't in the hot set
+        self._archived = {}    # key -> value of records that were in the cold segment then
+        self._aggregates = {}  # name -> (live aggregate, its rows at the snapshot), copied on demand
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def close(self):
+        self._db._views.discard(self)
+        self._saved = self._archived = None
+
+
+    def _preserve(self, key):
+        if key in self._saved:
+            return
+        db = self._db
+        if key in db._dict:
+            self._saved[key] = db._dict[key]
+            return
+        self._saved[key] = _MISSING
+        archived = db._cold.get(key)
+        if archived is not None:
+            self._archived[key] = archived
+
+
+    def _preserve_all(self):
+        for key in list(self._db._dict):
+            self._preserve(key)
+
+
+    def _matches(self, record, conditions):
+        return all(self._db._compare(_Field(field)(record), op, value) for field, op, value in conditions)
+
+
+    def __contains__(self, key):
+        if key in self._saved:
+            return self._saved[key] is not _MISSING or key in self._archived
+        return key in self._db
+
+
+    def __len__(self):
+        changed = sum((value is not _MISSING) - (key in self._db._dict) for key, value in self._saved.items())
+        return len(self._db._dict) + changed
+
+
+    def keys(self):
+        saved = self._saved
+        keys = [key for key in self._db._dict if key not in saved]
+        keys.extend(key for key, value in saved.items() if value is not _MISSING)
+        return keys
+
+
+    def __iter__(self):
+        return (self.get(key) for key in self.keys())
+
+
+    def get(self, key: int):
+        if key not in self._saved:
+            return self._db.get(key)
+        value = self._saved[key]
+        if value is _MISSING:
+            value = self._archived.get(key)
+        return None if value is None else Record(key, value)
+
+
+    def _select(self, kwargs):
+        db = self._db
+        conditions = db._parse_conditions(kwargs)
+        saved = self._saved
+        keys = [key for key in db._select(conditions) if key not in saved]
+        keys.extend(key for key, value in list(saved.items())
+                    if value is not _MISSING and self._matches(Record(key, value), conditions))
+        return keys
+
+
+    def where(self, first=False, /, **kwargs):
+        if not kwargs:
+            raise ValueError("Bad args in where")
+
+        ans = (self.get(key) for key in self._select(kwargs))
+        if first:
+            for a in ans:
+                return a
+            return None
+        return ans
+
+
+    def query(self, select=None, /, **kwargs):
+        records = (self.get(key) for key in self._select(kwargs))
+        if select is None:
+            return records
+
+        fields = [(name, _Field(name.replace("__", "."))) for name in select]
+        return ({name: field(record) for name, field in fields} for record in records)
+
+
+    def count(self, **kwargs):
+        if not kwargs:
+            return len(self)
+        return len(self._select(kwargs))
+
+
+    def range(self, index, lo=None, hi=None, /, reverse=False, limit=None, **kwargs):
+        db = self._db
+        if index not in db._indexes or db._indexes[index].kind != INDEX_SORTED:
+            raise ValueError(f"No sorted index {index} in db")
+
+        # positions are taken now, the index may change while this is consumed
+        field = db._index_fields[index]
+        saved = self._saved
+        live = []
+        for key in db._indexes[index].range(lo, hi, reverse):
+            if key not in saved:
+                value = db._dict.field(key, index)
+                live.append(((value is not None, value, key), key))
+        changed = []
+        for key, record in list(saved.items()):
+            if record is _MISSING:
+                continue
+            value = field(record)
+            try:
+                inside = lo is None if value is None else (
+                    (lo is None or value >= lo) and (hi is None or value < hi))
+            except TypeError:
+                inside = False
+            if inside:
+                changed.append(((value is not None, value, key), key))
+        changed.sort(reverse=reverse)
+
+        conditions = db._parse_conditions(kwargs)
+        found = 0
+        for _, key in heapq.merge(live, changed, reverse=reverse):
+            if limit is not None and found >= limit:
+                return
+            record = self.get(key)
+            if self._matches(record, conditions):
+                found += 1
+                yield record
+
+
+    def archived(self, **kwargs):
+        db = self._db
+        conditions = db._parse_conditions(kwargs)
+        saved = self._saved
+        for key, value in db._cold.items():
+            if key not in saved and key not in db._dict:
+                record = Record(key, value)
+                if self._matches(record, conditions):
+                    yield record
+        for key, value in list(self._archived.items()):
+            record = Record(key, value)
+            if self._matches(record, conditions):
+                yield record
+
+
+    def aggregate(self, name, group=_MISSING):
+        db = self._db
+        if name not in db._aggregates:
+            raise ValueError(f"No aggregate {name} in db")
+
+        # the live totals with changed records swapped back to their saved values
+        live = db._aggregates[name]
+        aggregate = _Aggregate(*live.spec())
+        aggregate.load([group, count, dict(total) if isinstance(total, dict) else total]
+                       for group, count, total in live.dump())
+        for key, value in list(self._saved.items()):
+            if key in db._dict:
+                aggregate.discard(db._dict[key])
+            if value is not _MISSING:
+                aggregate.add(value)
+
+        if group is not _MISSING:
+            return aggregate.total(group)
+        if aggregate.group_by is None:
+            return aggregate.total(None)
+        return aggregate.groups()
+
+
+class BayDB:
+    def __init__(self, filename, indexes=[], errors='ignore', durability=DURABILITY_FLUSH,
+                 commit_window=0.005, commit_batch=256, checkpoint_every=None, keep_checkpoints=2,
+                 lazy=False, cache_size=1024, compact_ratio=None, compact_min_records=1000,
+                 readonly=False, refresh_interval=0.01, aggregates={}, schema=None, metrics=None,
+                 log_format=None, query_cache_size=0):
+        self.max_id = -1
+        self._index_fields = {}
+        self._dict = _Records(self._index_fields)
+        self._indexes = {}
+        self._unique_indexes = set()
+        self._closed = False
+        
+        for idx in indexes:
+            if isinstance(idx, str):
+                index, options = idx, ()
+            else:
+                index, *options = idx
+
+            kind = INDEX_HASH
+            function = None
+            for option in options:
+                if isinstance(option, bool):
+                    if option:
+                        self._unique_indexes.add(index)
+                elif callable(option):
+                    function = option
+                elif option in INDEX_KINDS:
+                    kind = option
+                else:
+                    raise ValueError(f"Bad option {option!r} for index {index}")
+
+            if index == "id":
+                raise ValueError("Forbidden index name: id")
+            self._indexes[index] = INDEX_CLASSES[kind]()
+            self._index_fields[index] = _Field(index, function)
+
+        self._aggregates = {}
+        for name, (kind, *args) in aggregates.items():
+            if kind == AGGREGATE_COUNT:
+                args.insert(0, None)
+            self._aggregates[name] = _Aggregate(kind, *args)
+                
+        self._filename = filename
+        self._log_format = _detect_log_format(filename, log_format)
+        self._codec = LOG_CODECS[self._log_format]()
+        self._lazy = lazy
+        self._cache_size = cache_size
+        self._schema = None
+        if schema is not None:
+            if lazy:
+                raise ValueError("Schema mode keeps records in memory, it can't be lazy")
+            self._schema = _Schema(schema)
+            self._dict = _SchemaRecords(self._index_fields, self._schema)
+        if lazy:
+            self._dict = _LazyRecords(filename, self._index_fields, cache_size, self._sync_log, self._codec.decode)
+        self._readonly = readonly
+        self._refresh_interval = refresh_interval
+        self._last_refresh = time.monotonic()
+        self._errors = errors
+        self._durability = durability
+        self._commit_window = commit_window
+        self._commit_batch = commit_batch
+        self._checkpoint_every = checkpoint_every
+        self._keep_checkpoints = keep_checkpoints
+        self._ops_since_checkpoint = 0
+        self._compact_ratio = compact_ratio
+        self._compact_min_records = compact_min_records
+        self._log_records = 0
+        self._compact_after = 0
+        self._compaction = None
+        self._batch = None
+        self._undo = None
+        self._subscribers = []
+        self._events = []
+        self._log_generation = 0
+        self._checkpoint_lock = threading.Lock()
+        self._background_checkpoints = False
+        self._writer = None
+        self._lock_file = None
+        self._metrics = Metrics() if metrics is True else metrics or None
+        self._cold = None
+        self._cold_discards = None
+        self._views = weakref.WeakSet()
+        self._query_cache_size = query_cache_size
+        self._query_cache = collections.OrderedDict() if query_cache_size else None
+        self._versions = {}    # (index, value) -> changes of records with it, hash and bitmap indexes
+        self._version = 0      # changes of any record
+
+        if not readonly:
+            self._acquire_lock()
+        try:
+            self._load(errors)
+        except BaseException:
+            if self._lock_file is not None:
+                self._lock_file.close()  # a refused open doesn't keep the log locked
+            raise
+        if not readonly:
+            self._open_writer()
+        if self._metrics is not None:
+            self._instrument()
+
+
+    def _instrument(self):
+        # timed wrappers shadow the methods on this instance only, so a db
+        # without metrics runs the plain methods. They hold a weak reference
+        # to keep the db collectable as soon as it is dropped
+        ref = weakref.ref(self)
+
+        def timed_iteration(metrics, name, records, elapsed):
+            # a lazy result does its work while consumed, time spent by the consumer between records is left out
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        record = next(records)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield record
+            finally:
+                metrics.observe(name, elapsed)
+
+        def timed(name, method):
+            @functools.wraps(method)
+            def wrapper(*args, **kwargs):
+                db = ref()
+                db._metrics.count(f"ops.{name}")
+                start = time.perf_counter()
+                try:
+                    result = method(db, *args, **kwargs)
+                except BaseException:
+                    db._metrics.observe(name, time.perf_counter() - start)
+                    raise
+                if isinstance(result, types.GeneratorType):
+                    return timed_iteration(db._metrics, name, result, time.perf_counter() - start)
+                db._metrics.observe(name, time.perf_counter() - start)
+                return result
+            return wrapper
+
+        for name in INSTRUMENTED_OPERATIONS:
+            setattr(self, name, timed(name, getattr(type(self), name)))
+
+
+    def __del__(self):
+        if getattr(self, "_writer", None) is not None:
+            self._writer.close()
+        if getattr(self, "_lazy", False):
+            self._dict.close()
+
+
+    def _acquire_lock(self):
+        if fcntl is None:
+            return
+
+        self._lock_file = open(self._filename + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise BlockingIOError(errno.EAGAIN, f"{self._filename} is opened for writing by another process") from None
+
+
+    def _check_writable(self):
+        if self._readonly:
+            raise io.UnsupportedOperation("Database is opened read-only")
+
+
+    def _open_writer(self):
+        header = self._codec.header()
+        if header:
+            # written past the group commit queue, a replica opened right after must see the format
+            with open(self._filename, "ab") as f:
+                if f.tell() == 0:
+                    f.write(header)
+                    f.flush()
+                    os.fsync(f.fileno())
+        self._writer = _LogWriter(self._filename, self._durability, self._commit_window, self._commit_batch)
+
+
+    def flush(self):
+        if self._writer is not None:
+            self._writer.flush()
+
+
+    def _sync_log(self, offset):
+        if self._writer is not None and offset > self._writer.written:
+            self._writer.flush()
+
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        if not self._readonly:
+            if self._compaction is not None:
+                self._compaction.thread.join()
+                self._finish_compaction(raise_errors=False)
+            if self._checkpoint_every and self._ops_since_checkpoint:
+                self.checkpoint()
+            self._writer.close()
+            if self._lock_file is not None:
+                self._lock_file.close()
+        if self._lazy:
+            self._dict.close()
+
+
+    def _reset(self):
+        kinds = self._index_kinds()
+        self._indexes = {index: INDEX_CLASSES[kind]() for index, kind in kinds.items()}
+        self._aggregates = {name: _Aggregate(*aggregate.spec()) for name, aggregate in self._aggregates.items()}
+        self._codec = LOG_CODECS[self._log_format]()
+        if self._lazy:
+            self._dict.close()
+            self._dict = _LazyRecords(self._filename, self._index_fields, self._cache_size, self._sync_log,
+                                      self._codec.decode)
+        elif self._schema is not None:
+            self._dict = _SchemaRecords(self._index_fields, self._schema)
+        else:
+            self._dict = _Records(self._index_fields)
+        self.max_id = -1
+        self._log_records = 0
+        self._ops_since_checkpoint = 0
+        if self._query_cache is not None:
+            self._query_cache.clear()
+
+
+    def refresh(self):
+        self._last_refresh = time.monotonic()
+        try:
+            f = open(self._filename, "rb")
+        except FileNotFoundError:
+            return
+
+        with f:
+            stat = os.fstat(f.fileno())
+            if not self._tail_offset and stat.st_size:
+                # opened on an empty log, its format is known only now
+                log_format = _detect_log_format(self._filename)
+                if log_format != self._log_format:
+                    self._log_format = log_format
+                    self._reset()
+                    self._load(self._errors)
+                    return
+            if (stat.st_dev, stat.st_ino) != self._log_identity or stat.st_size < self._tail_offset:
+                # the log was compacted and replaced
+                for view in self._views:
+                    view._preserve_all()
+                self._reset()
+                self._load(self._errors)
+            elif stat.st_size > self._tail_offset:
+                self._tail_offset = self._replay_log(f, self._tail_offset, self._errors, True)
+                self._open_cold()
+
+
+    def _maybe_refresh(self):
+        if self._readonly and time.monotonic() - self._last_refresh >= self._refresh_interval:
+            self.refresh()
+
+
+    def _load(self, errors):
+        start = time.perf_counter()
+        offset = self._load_checkpoint()
+        self._log_identity = None
+        self._tail_offset = offset
+
+        try:
+            with open(self._filename, "rb") as f:
+                stat = os.fstat(f.fileno())
+                self._log_identity = (stat.st_dev, stat.st_ino)
+                self._tail_offset = self._replay_log(f, offset, errors, offset > 0)
+        except FileNotFoundError:
+            pass
+
+        if not self._readonly and self._log_identity is not None:
+            # new records must start right after the last whole one, not continue a torn one
+            if os.path.getsize(self._filename) > self._tail_offset:
+                self._cut_torn_tail()
+
+        self._open_cold()
+        if self._metrics is not None:
+            self._metrics.observe("load", time.perf_counter() - start)
+            self._metrics.count("load.checkpoint_bytes", offset)
+
+
+    def _cut_torn_tail(self):
+        # nothing valid follows the tail, still keep the bytes aside in case they were a record
+        with open(self._filename, "rb") as f:
+            f.seek(self._tail_offset)
+            torn = f.read()
+        with open(self._filename + ".torn", "ab") as f:
+            f.write(torn)
+            f.flush()
+            os.fsync(f.fileno())
+        os.truncate(self._filename, self._tail_offset)
+
+
+    def _open_cold(self):
+        self._cold = _ColdSegment(self._filename + ".cold", self._log_format)
+        self.max_id = max(self.max_id, self._cold.max_id)  # archived keys are never reused
+
+
+    def _replay_log(self, f, offset, errors, indexed):
+        touched = set()
+        position = offset
+        binary = self._log_format == LOG_BINARY
+        for record_offset, length, data, complete in self._codec.scan(f, offset):
+            if not complete:
+                break  # the writer is in the middle of this record, or crashed there
+            position = record_offset + length
+            self._log_records += 1
+            try:
+                obj = self._codec.decode(data)
+                self._ops_since_checkpoint += 1
+                for action, key, payload in _log_entries(obj):
+                    key = int(key)
+                    self._preserve(key)
+                    self._invalidate(key)
+                    if indexed and key not in touched:
+                        self._discard_indexes(key)
+                    touched.add(key)
+                    self._replay(action, key, payload, record_offset, length)
+            except (ValueError, LookupError, TypeError, EOFError):
+                if errors != 'ignore':
+                    raise
+        if binary:
+            position = self._codec.end  # includes trailing key frames
+
+        self.max_id = max(self.max_id, max(self._dict)) if self._dict else self.max_id
+
+        self._check_bitmap_keys(touched if indexed else self._dict)
+        for key in (touched if indexed else self._dict):
+            self._update_indexes(key)
+        if self._metrics is not None:
+            self._metrics.count("replay.bytes", position - offset)
+        return position
+
+
+    def _replay(self, action, key, payload, offset, length):
+        if self._lazy:
+            self._dict.replay(action, key, payload, offset, length)
+        elif action == "set":
+            if "id" in payload:
+                del payload["id"]
+            self._dict[key] = payload
+        elif action == "update":
+            payload.pop("id", None)
+            self._dict.merge(key, payload)
+        elif action == "delete":
+            del self._dict[key]
+        elif action == "archive":
+            self._dict.pop(key, None)  # the record lives in the cold segment
 
-    # Deleting records
-    orders.delete(43)
 
-    # Database compaction (reduces file size)
-    orders.compact()
-"""
+    def _checkpoint_files(self):
+        files = []
+        for name in glob.glob(glob.escape(self._filename) + ".ckpt.*"):
+            seq = name.rsplit(".", 1)[1]
+            if seq.isdigit():
+                files.append((int(seq), name))
+        return [name for seq, name in sorted(files, reverse=True)]
 
 
-import json
-import collections
-import os
+    def _log_tail_crc(self, offset):
+        start = max(0, offset - CHECKPOINT_TAIL_CHECK)
+        with open(self._filename, "rb") as f:
+            f.seek(start)
+            data = f.read(offset - start)
+        if len(data) != offset - start:
+            raise ValueError("Log is shorter than checkpoint")
+        return zlib.crc32(data)
 
 
-class BayDB:
-    def __init__(self, filename, indexes=[], errors='ignore'):
-        self.max_id = -1
-        self._dict = {}
-        self._indexes = {}
-        self._unique_indexes = set()
-        
-        for idx in indexes:
+    def _load_checkpoint(self):
+        for name in self._checkpoint_files():
             try:
-                index, is_uniq = idx
-                if is_uniq:
-                    self._unique_indexes.add(index)
-            except ValueError:
-                index = idx
-
-            if index == "id":
-                raise ValueError("Forbidden index name: id")
-            self._indexes[index] = collections.defaultdict(set)
-                
-        self._filename = filename
-        self._load(errors)
-        self._file = open(self._filename, "a", encoding="utf8")
+                with open(name, "rb") as f:
+                    header = json.loads(f.readline())
+                    body = f.read()
+                if header["version"] != CHECKPOINT_VERSION or zlib.crc32(body) != header["crc"]:
+                    continue
+                if header.get("lazy", False) != self._lazy or header.get("format", LOG_JSON) != self._log_format:
+                    continue
+                offset = header["offset"]
+                if offset and self._log_tail_crc(offset) != header["log_crc"]:
+                    continue
+                state = json.loads(body)
+                if not self._codec.load_state(state.get("log_keys")):
+                    continue
+            except (OSError, ValueError, LookupError):
+                continue
+
+            self._log_records = state.get("log_records", len(state["data"]))
+            if self._lazy:
+                self._dict.load_state(state["data"])
+            else:
+                for key, value in state["data"]:
+                    self._dict[key] = value
+            self.max_id = state["max_id"]
+
+            if state.get("kinds") == self._index_kinds() and state["unique"] == sorted(self._unique_indexes):
+                functions = [index for index, field in self._index_fields.items() if field.is_function()]
+                for index, pairs in state["indexes"].items():
+                    if index not in functions:
+                        self._indexes[index].load(pairs)
+                for key in self._dict:
+                    for index in functions:
+                        self._update_index(index, key)
+                if state.get("aggregates") == self._aggregate_specs():
+                    for name, rows in state["aggregate_totals"].items():
+                        self._aggregates[name].load(rows)
+                else:
+                    for key in self._dict:
+                        self._update_aggregates(key)
+            else:
+                self._check_bitmap_keys(self._dict)
+                for key in self._dict:
+                    self._update_indexes(key)
+            return offset
+
+        return 0
+
+
+    def checkpoint(self):
+        self._check_writable()
+        self._write_checkpoint(*self._checkpoint_state())
+
+
+    def _checkpoint_state(self):
+        if self._batch is not None:
+            raise ValueError("Can't checkpoint inside a batch")
+
+        self._ops_since_checkpoint = 0
+        offset = self._writer.offset
+        state = {
+            "max_id": self.max_id,
+            "log_records": self._log_records,
+            "data": self._dict.state() if self._lazy else list(self._dict.items()),
+            "indexes": {index: values.dump() for index, values in self._indexes.items()
+                        if not self._index_fields[index].is_function()},
+            "kinds": self._index_kinds(),
+            "unique": sorted(self._unique_indexes),
+            "aggregates": self._aggregate_specs(),
+            "log_keys": self._codec.state(),
+            "aggregate_totals": {name: aggregate.dump() for name, aggregate in self._aggregates.items()},
+        }
+        return offset, state, self._log_generation
+
+
+    def _write_checkpoint(self, offset, state, generation):
+        start = time.perf_counter()
+        self._sync_log(offset)
+        body = json.dumps(state, ensure_ascii=False, default=_plain).encode("utf8")
+
+        with self._checkpoint_lock:
+            if generation != self._log_generation:
+                return  # the log was compacted meanwhile, offset means nothing now
+
+            header = {
+                "version": CHECKPOINT_VERSION,
+                "offset": offset,
+                "crc": zlib.crc32(body),
+                "log_crc": self._log_tail_crc(offset) if offset else 0,
+                "lazy": self._lazy,
+                "format": self._log_format,
+            }
+
+            files = self._checkpoint_files()
+            seq = int(files[0].rsplit(".", 1)[1]) + 1 if files else 0
+            name = f"{self._filename}.ckpt.{seq}"
+            with open(name + ".tmp", "wb") as f:
+                f.write(json.dumps(header).encode("utf8") + b"\n")
+                f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(name + ".tmp", name)
+
+            for old in files[max(self._keep_checkpoints - 1, 0):]:
+                os.remove(old)
+
+        if self._metrics is not None:
+            self._metrics.observe("checkpoint.write", time.perf_counter() - start)
+            self._metrics.count("checkpoint.bytes", len(body))
+
+
+    def _auto_checkpoint(self):
+        checkpoint = self._checkpoint_state()
+        if self._background_checkpoints:
+            threading.Thread(target=self._write_checkpoint, args=checkpoint,
+                             name=f"baydb-checkpoint:{self._filename}", daemon=True).start()
+        else:
+            self._write_checkpoint(*checkpoint)
 
 
-    def __del__(self):
-        if hasattr(self, "_file"):
-            self._file.close()
+    def _index_kinds(self):
+        return {index: values.kind for index, values in self._indexes.items()}
 
 
-    def _load(self, errors):
-        try:
-            with open(self._filename, "r") as f:
-                for line in f:
-                    try:
-                        obj = json.loads(line)
-                        action, key = obj[0], int(obj[1])
-                        if action == "set":
-                            value = obj[2]
-                            if "id" in value:
-                                del value["id"]
-                            self._dict[key] = value
-                        elif action == "update":
-                            kv = obj[2]
-                            for subkey, value in kv.items():
-                                if subkey == "id":
-                                    continue
-                                self._dict[key][subkey] = value
-                        elif action == "delete":
-                            del self._dict[key]
-                    except (ValueError, LookupError):
-                        if errors != 'ignore':
-                            raise
-        except FileNotFoundError:
-            pass
+    def _aggregate_specs(self):
+        return {name: aggregate.spec() for name, aggregate in self._aggregates.items()}
 
-        self.max_id = max(self._dict) if self._dict else -1
 
-        for key in self._dict:
-            self._update_indexes(key)
+    def _remove_checkpoints(self):
+        for name in self._checkpoint_files():
+            os.remove(name)
 
 
     def __contains__(self, key):
-        return key in self._dict
+        self._maybe_refresh()
+        return key in self._dict or key in self._cold
 
 
     def __iter__(self):
-        return ({"id": key} | self.get(key) for key in self._dict)
+        self._maybe_refresh()
+        return self._records(self._dict)
 
 
     def _discard_index(self, index, key):
         if index not in self._indexes:
             return
 
-        value = self._dict.get(key, {}).get(index)
-        self._indexes[index][value].discard(key)
+        value = self._dict.field(key, index)
+        self._indexes[index].discard(value, key)
 
 
     def _discard_indexes(self, key):
         for index in self._indexes:
             self._discard_index(index, key)
+        self._discard_aggregates(key)
 
 
     def _update_index(self, index, key):
@@ -126,28 +2511,186 @@ class BayDB:
             return
 
         if key in self._dict:
-            value = self._dict[key].get(index)
-            
-            if index in self._unique_indexes and value is not None:
-                existing_keys = self._indexes[index][value]
-                existing_keys_except_current = [k for k in existing_keys if k != key]
-                
-                if existing_keys_except_current:
-                    existing_key = existing_keys_except_current[0]
-                    raise ValueError(f"Unique violation for index '{index}' with value '{value}'. "
-                                     f"Already used by record with key {existing_key}")
+            value = self._dict.field(key, index)
             
-            self._indexes[index][value].add(key)
+            self._check_unique(index, key, value)
+            self._indexes[index].add(value, key)
+            if self._query_cache:
+                self._bump(index, value)
+
+
+    def _check_unique(self, index, key, value):
+        if index in self._unique_indexes and value is not None:
+            if self._metrics is not None:
+                self._metrics.count("unique.checks")
+            existing_keys = self._indexes[index].lookup(value)
+            existing_keys_except_current = [k for k in existing_keys if k != key]
+
+            if existing_keys_except_current:
+                if self._metrics is not None:
+                    self._metrics.count("unique.violations")
+                existing_key = existing_keys_except_current[0]
+                raise ValueError(f"Unique violation for index '{index}' with value '{value}'. "
+                                 f"Already used by record with key {existing_key}")
+
+
+    def _check_bitmap_keys(self, keys):
+        # logs written without a bitmap index may hold negative keys, refuse them up front
+        bitmaps = [index for index, values in self._indexes.items() if values.kind == INDEX_BITMAP]
+        if bitmaps:
+            negative = next((key for key in keys if key < 0), None)
+            if negative is not None:
+                raise ValueError(f"{self._filename} has negative key {negative}, bitmap index '{bitmaps[0]}' "
+                                 f"only holds keys >= 0: declare it as a hash index")
+
+
+    def _check_sortable(self, indexes, key, value):
+        # like the unique check, a value a sorted index can't order is refused before anything changes
+        for index in indexes:
+            if self._indexes[index].kind == INDEX_SORTED:
+                self._indexes[index].check(self._index_fields[index](value), key)
 
 
     def _update_indexes(self, key):
         for index in self._indexes:
             self._update_index(index, key)
+        self._update_aggregates(key)
+
+
+    def _discard_aggregates(self, key):
+        if self._aggregates and key in self._dict:
+            value = self._dict[key]
+            for aggregate in self._aggregates.values():
+                aggregate.discard(value)
+
+
+    def _update_aggregates(self, key):
+        if self._aggregates and key in self._dict:
+            value = self._dict[key]
+            for aggregate in self._aggregates.values():
+                aggregate.add(value)
             
 
+    def _remember(self, key):
+        if self._undo is not None:
+            self._undo.append((key, self._dict.save_entry(key)))
+        self._preserve(key)
+        self._invalidate(key)
+
+
+    def _invalidate(self, key):
+        # versions only matter to cached results, with none there is nothing to bump
+        if not self._query_cache:
+            return
+        self._version += 1
+        if key in self._dict:
+            for index in self._indexes:
+                self._bump(index, self._dict.field(key, index))
+
+
+    def _bump(self, index, value):
+        if self._indexes[index].kind != INDEX_SORTED:
+            self._versions[index, value] = self._versions.get((index, value), 0) + 1
+
+
+    def _preserve(self, key):
+        for view in self._views:
+            view._preserve(key)
+
+
+    def snapshot_view(self):
+        """
+        Returns a SnapshotView of the current state. Writers are not
+        blocked; close the view, or use it as a context manager, to stop
+        saving changed records into it.
+        """
+        self._maybe_refresh()
+        view = SnapshotView(self)
+        self._views.add(view)
+        return view
+
+
+    def _notify(self, op, key, old, new):
+        if not self._subscribers:
+            return
+
+        change = Change(op, key, None if old is None else Record(key, old),
+                        None if new is None else Record(key, new))
+        if self._batch is not None:
+            self._events.append(change)
+        else:
+            self._dispatch([change])
+
+
+    def _dispatch(self, changes):
+        for change in changes:
+            for subscription in list(self._subscribers):
+                if not subscription.conditions or any(
+                        record is not None and all(self._compare(_Field(field)(record), op, value)
+                                                   for field, op, value in subscription.conditions)
+                        for record in (change.old, change.new)):
+                    try:
+                        subscription.callback(change)
+                    except Exception as e:
+                        # the change is already committed, one failing subscriber must not fail
+                        # the write or keep the others from hearing about it
+                        if self._metrics is not None:
+                            self._metrics.count("subscribers.errors")
+                        print(f"Exception ignored in BayDB subscriber {subscription.callback!r}:", file=sys.stderr)
+                        traceback.print_exception(e)
+
+
+    def subscribe(self, callback, **kwargs):
+        subscription = types.SimpleNamespace(callback=callback, conditions=self._parse_conditions(kwargs))
+        self._subscribers.append(subscription)
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        if subscription in self._subscribers:
+            self._subscribers.remove(subscription)
+
+
+    async def changes(self, **kwargs):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        subscription = self.subscribe(lambda change: loop.call_soon_threadsafe(queue.put_nowait, change), **kwargs)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(subscription)
+
+
     def _save(self, *args):
-        self._file.write(json.dumps(args, ensure_ascii=False) + "\n")
-        self._file.flush()
+        if self._batch is not None:
+            self._batch.append(list(args))
+            return
+
+        prefix, data = self._codec.encode(args)
+        if prefix:
+            self._writer.write(prefix)
+        offset = self._writer.write(data)
+        if self._metrics is not None:
+            self._metrics.count("log.bytes_written", len(prefix) + len(data))
+            self._metrics.count("log.records_written")
+        if self._lazy:
+            for action, key, _ in _log_entries(args):
+                if action != "delete":
+                    self._dict.locate(key, action, offset, len(data))
+
+        self._log_records += 1
+        if self._compaction is not None:
+            if not self._compaction.thread.is_alive():
+                self._finish_compaction(raise_errors=False)
+        elif (self._compact_ratio is not None and
+              self._log_records >= max(self._compact_min_records, self._compact_after)):
+            if 1 - len(self._dict) / self._log_records >= self._compact_ratio:
+                self._start_compaction(self._filename + ".tmp")
+
+        self._ops_since_checkpoint += 1
+        if self._checkpoint_every and self._ops_since_checkpoint >= self._checkpoint_every:
+            self._auto_checkpoint()
 
 
     def append(self, value: dict) -> int:
@@ -155,62 +2698,197 @@ class BayDB:
             raise ValueError("You can't insert element with 'id', use set")
 
         key = self.max_id + 1
-        self.set(key, value)
-        return self.get(key)
+        return BayDB.set(self, key, value)  # not the timed wrapper, one append is one operation
 
 
     def set(self, key: int, value: dict):
+        self._check_writable()
         if not isinstance(key, int):
             raise TypeError("Key should be int")
         if not isinstance(value, dict):
             raise TypeError("Value should be dict")
+        if key < 0 and any(index.kind == INDEX_BITMAP for index in self._indexes.values()):
+            raise ValueError(f"Bitmap index can't hold negative key {key}")
         if "id" in value:
             del value["id"]
+        for index in self._unique_indexes:
+            self._check_unique(index, key, self._index_fields[index](value))
+        self._check_sortable(self._indexes, key, value)
 
+        self._remember(key)
+        old = self._dict.get(key) if self._subscribers else None
         self._discard_indexes(key)
         self.max_id = max(key, self.max_id)
         self._dict[key] = value
         self._update_indexes(key)
         self._save("set", key, value)
-        return self.get(key)
+        self._discard_cold(key)
+        self._notify("set", key, old, value)
+        return self._record(key)
 
 
     def update(self, key: int, **kwargs):
+        self._check_writable()
         if not isinstance(key, int):
             raise TypeError("Key should be int")
         if "id" in kwargs:
             raise ValueError("You can't update id subkey")
         if key not in self._dict:
-            raise KeyError
-
+            archived = self._cold.get(key)
+            if archived is None:
+                raise KeyError
+            BayDB.set(self, key, archived)  # back to the hot set
+        old = self._dict[key]
+        new = old | kwargs
+        affected = [index for index, field in self._index_fields.items() if field.affected_by(kwargs)]
+        for index in affected:
+            self._check_unique(index, key, self._index_fields[index](new))
+        self._check_sortable(affected, key, new)
+
+        self._remember(key)
         self.max_id = max(key, self.max_id)
-        for subkey, value in kwargs.items():
-            self._discard_index(subkey, key)
-            self._dict[key][subkey] = value
-            self._update_index(subkey, key)
+        for index in affected:
+            self._discard_index(index, key)
+        self._discard_aggregates(key)
+        self._dict[key] = new
+        for index in affected:
+            self._update_index(index, key)
+        self._update_aggregates(key)
 
         self._save("update", key, kwargs)
-        return self.get(key)
+        self._notify("update", key, old, self._dict[key])
+        return self._record(key)
 
 
     def delete(self, key: int):
+        self._check_writable()
+        if key not in self._dict and key in self._cold:
+            self._preserve(key)
+            old_val = self._cold.get(key)
+            self._discard_cold(key)
+            self._notify("delete", key, old_val, None)
+            return old_val
         if key in self._dict:
+            self._remember(key)
             self._discard_indexes(key)
             old_val = self._dict[key]
             del self._dict[key]
             self._update_indexes(key)
             self._save("delete", key, old_val)
+            self._discard_cold(key)  # left over from a crash in archive(), see there
+            self._notify("delete", key, old_val, None)
             return old_val
 
 
+    @contextlib.contextmanager
+    def batch(self):
+        self._check_writable()
+        if self._batch is not None:
+            yield self
+            return
+
+        self._batch, self._undo, self._events, self._cold_discards = [], [], [], []
+        max_id = self.max_id
+        try:
+            yield self
+        except BaseException:
+            for key, entry in reversed(self._undo):
+                self._preserve(key)
+                self._invalidate(key)
+                self._discard_indexes(key)
+                self._dict.restore_entry(key, entry)
+                self._update_indexes(key)
+            self.max_id = max_id
+            raise
+        finally:
+            ops, self._batch, self._undo = self._batch, None, None
+            changes, self._events = self._events, []
+            cold_discards, self._cold_discards = self._cold_discards, None
+
+        if len(ops) == 1:
+            self._save(*ops[0])
+        elif ops:
+            self._save("batch", len(ops), ops)
+        for key in cold_discards:
+            self._discard_cold(key)
+        self._dispatch(changes)
+
+
+    def apply(self, ops):
+        with self.batch():
+            for op in ops:
+                action, key, *payload = op
+                if action == "set":
+                    BayDB.set(self, key, *payload)
+                elif action == "update":
+                    BayDB.update(self, key, **payload[0])
+                elif action == "delete":
+                    BayDB.delete(self, key)
+                else:
+                    raise ValueError(f"Unknown action {action}")
+
+
+    def _discard_cold(self, key):
+        # a cold copy may go only once the log has the record that replaces it
+        if key not in self._cold:
+            return
+        if self._cold_discards is not None:
+            self._cold_discards.append(key)
+        else:
+            self._sync_log(self._writer.offset)
+            self._cold.discard(key)
+
+
+    def archive(self, **kwargs) -> int:
+        """
+        Moves records matching the conditions to the cold segment. They
+        leave memory, indexes and aggregates but keep their keys. Returns
+        the number of archived records.
+        """
+        self._check_writable()
+        if not kwargs:
+            raise ValueError("Bad args in archive")
+        if self._batch is not None:
+            raise ValueError("Can't archive inside a batch")
+
+        keys = sorted(self._select(self._parse_conditions(kwargs)))
+        if not keys:
+            return 0
+        # cold copies are durable before the log drops the hot ones, a crash
+        # in between leaves both and the hot one wins
+        self._cold.add((key, self._dict[key]) for key in keys)
+        with self.batch():
+            for key in keys:
+                self._remember(key)
+                self._discard_indexes(key)
+                old_val = self._dict[key]
+                del self._dict[key]
+                self._save("archive", key, {})
+                self._notify("archive", key, old_val, None)
+        if self._metrics is not None:
+            self._metrics.count("archive.records", len(keys))
+        return len(keys)
+
+
+    def archived(self, **kwargs):
+        """Scans the cold segment, yields archived records matching the conditions."""
+        self._maybe_refresh()
+        conditions = self._parse_conditions(kwargs)
+        for key, value in self._cold.items():
+            if key in self._dict:
+                continue  # archived and then brought back, see archive()
+            record = Record(key, value)
+            if all(self._compare(_Field(field)(record), op, value) for field, op, value in conditions):
+                yield record
+
+
     def get(self, key: int=None, /, **kwargs):
+        self._maybe_refresh()
         if "id" in kwargs:
             key = kwargs["id"]
 
         if key is not None:
-            if key not in self._dict:
-                return None
-            return {"id": key} | self._dict.get(key)
+            return self._record(key)
         else:
             if len(kwargs) != 1:
                 raise ValueError(f"Get with too many keyword args")
@@ -219,20 +2897,169 @@ class BayDB:
             if index not in self._unique_indexes:
                 raise ValueError(f"No unique index {index} in db")
 
-            ans = ({"id": key} | self.get(key) for key in self._indexes.get(index, {}).get(value, []))
-            for i in ans:
-                return i
+            for key in self._indexes[index].lookup(value):
+                return self._record(key)
 
 
-    def where(self, first=False, /, **kwargs) -> list[dict]:
-        if len(kwargs) != 1:
+    def _record(self, key):
+        if key not in self._dict:
+            value = self._cold.get(key)
+            return None if value is None else Record(key, value)
+        return Record(key, self._dict[key])
+
+
+    def _records(self, keys):
+        # a replica refreshes once when the query starts, not under it, and
+        # keys deleted since the query was planned are skipped
+        for key in keys:
+            record = self._record(key)
+            if record is not None:
+                yield record
+
+
+    def _parse_conditions(self, kwargs):
+        conditions = []
+        for name, value in kwargs.items():
+            field, sep, op = name.rpartition("__")
+            if not sep or op not in WHERE_OPS:
+                field, op = name, "eq"
+            field = field.replace("__", ".")
+            if op == "in":
+                value = set(value)
+            conditions.append((field, op, value))
+        return conditions
+
+
+    def _getter(self, field):
+        if field == "id":
+            return lambda key: key
+        if field in self._indexes:
+            return functools.partial(self._dict.field, name=field)
+
+        path = _Field(field)
+        records = self._dict
+        return lambda key: path(records[key])
+
+
+    def _compile(self, condition):
+        field, op, value = condition
+        get = self._getter(field)
+        test = _TESTS[op]
+        return lambda key: test(get(key), value)
+
+
+    @staticmethod
+    def _compare(actual, op, value):
+        return _TESTS[op](actual, value)
+
+
+    def _plan(self, conditions):
+        """
+        Takes the candidate keys from the indexed condition that matches the
+        fewest records, judged by index counts without building any set.
+        Conditions on bitmap indexes are ANDed into one bitmap first. All
+        other conditions become compiled filters over the candidates.
+        """
+        terms = []     # (estimated count, candidates builder, filter)
+        filters = []
+        bitmaps = []
+        for condition in conditions:
+            field, op, value = condition
+            if field == "id" and op in ("eq", "in"):
+                values = [value] if op == "eq" else value
+                terms.append((len(values), lambda values=values: {key for key in values if key in self._dict},
+                              self._compile(condition)))
+                continue
+
+            index = self._indexes.get(field)
+            estimate = index.estimate(op, value) if index is not None else None
+            if estimate is None:
+                filters.append(self._compile(condition))
+            elif index.kind == INDEX_BITMAP:
+                bitmaps.append(index.select(op, value))
+            else:
+                terms.append((estimate, functools.partial(index.select, op, value), self._compile(condition)))
+
+        if bitmaps:
+            bits = functools.reduce(operator.and_, bitmaps)
+            terms.append((len(bits), lambda: bits, bits.__contains__))
+
+        if not terms:
+            return self._dict, filters
+        terms.sort(key=operator.itemgetter(0))
+        return terms[0][1](), [test for _, _, test in terms[1:]] + filters
+
+
+    def _select(self, conditions):
+        return self._scan(*self._plan(conditions))
+
+
+    def _scan(self, candidates, filters):
+        for key in list(candidates):
+            if key in self._dict and all(test(key) for test in filters):
+                yield key
+
+
+    def _guard(self, conditions):
+        """
+        Version a cached result depends on. Any record in the result before
+        or after a change matches every condition, so one equality
+        condition on a hash or bitmap index is enough to notice it.
+        """
+        for field, op, value in conditions:
+            index = self._indexes.get(field)
+            if index is not None and index.kind != INDEX_SORTED and op in ("eq", "in"):
+                values = [value] if op == "eq" else value
+                return field, sum(self._versions.get((field, v), 0) for v in values)
+        return self._version
+
+
+    def _cached(self, kind, conditions, compute, *args):
+        cache = self._query_cache
+        try:
+            key = (kind, tuple((field, op, frozenset(value) if op == "in" else value)
+                               for field, op, value in conditions), args)
+            hash(key)
+        except TypeError:
+            return compute()  # unhashable values can't be cached
+
+        guard = self._guard(conditions)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == guard:
+            cache.move_to_end(key)
+            if self._metrics is not None:
+                self._metrics.count("query_cache.hits")
+            return entry[1]
+
+        result = compute()
+        cache[key] = (guard, result)
+        cache.move_to_end(key)
+        if len(cache) > self._query_cache_size:
+            cache.popitem(last=False)
+        if self._metrics is not None:
+            self._metrics.count("query_cache.misses")
+        return result
+
+
+    def where(self, first=False, /, limit=None, after=None, order_by=None, **kwargs) -> list[dict]:
+        if not kwargs and limit is None:
             raise ValueError("Bad args in where")
-
-        index, value = next(iter(kwargs.items()))
-
-        if index not in self._indexes:
-            raise ValueError(f"No index {index} in db")
-        ans = ({"id": key} | self.get(key) for key in self._indexes.get(index, {}).get(value, []))
+        self._maybe_refresh()
+
+        conditions = self._parse_conditions(kwargs)
+        if limit is not None:
+            if self._query_cache is None:
+                return self._page(conditions, limit, after, order_by)
+            return self._cached("page", conditions, lambda: self._page(conditions, limit, after, order_by),
+                                limit, after, order_by)
+
+        if self._query_cache is not None:
+            if first:
+                return self._cached("first", conditions,
+                                    lambda: next(self._records(self._select(conditions)), None))
+            return iter(self._cached("where", conditions, lambda: list(self._records(self._select(conditions)))))
+
+        ans = self._records(self._select(conditions))
         if first:
             for a in ans:
                 return a
@@ -240,25 +3067,599 @@ class BayDB:
         return ans
 
 
+    def query(self, select=None, /, **kwargs):
+        self._maybe_refresh()
+        keys = self._select(self._parse_conditions(kwargs))
+        if select is None:
+            return self._records(keys)
+
+        getters = [(name, self._getter(name.replace("__", "."))) for name in select]
+        return ({name: get(key) for name, get in getters} for key in keys)
+
+
+    def count(self, **kwargs):
+        self._maybe_refresh()
+        if not kwargs:
+            return len(self._dict)
+
+        conditions = self._parse_conditions(kwargs)
+        if self._query_cache is not None:
+            return self._cached("count", conditions, lambda: self._count(conditions))
+        return self._count(conditions)
+
+
+    def _count(self, conditions):
+        candidates, filters = self._plan(conditions)
+        if not filters:
+            return len(candidates)
+        return sum(1 for _ in self._scan(candidates, filters))
+
+
+    def _page(self, conditions, limit, after, order_by):
+        if limit < 1:
+            raise ValueError("Page limit should be positive")
+        field, reverse = _order_field(order_by)
+        start = _decode_cursor(after) if after is not None else None
+
+        get = self._getter(field) if field is not None else None
+
+        def position(key):
+            if get is None:
+                return (key,)
+            value = get(key)
+            return (value is not None, value, key)
+
+        candidates, filters = self._plan(conditions)
+        index = self._indexes.get(field)
+        if candidates is self._dict and index is not None and index.kind == INDEX_SORTED:
+            # walk the index from the cursor, stop as soon as the page is full
+            keys = (key for key in index.range_after(start, reverse) if all(test(key) for test in filters))
+            found = list(itertools.islice(keys, limit + 1))
+        else:
+            keys = self._scan(candidates, filters)
+            if start is not None:
+                keys = (key for key in keys if (position(key) < start if reverse else position(key) > start))
+            pick = heapq.nlargest if reverse else heapq.nsmallest
+            found = pick(limit + 1, keys, key=position)
+
+        cursor = _encode_cursor(position(found[limit - 1])) if len(found) > limit else None
+        return Page([self._record(key) for key in found[:limit]], cursor)
+
+
+    def stats(self):
+        self._maybe_refresh()
+        stats = {
+            "records": len(self._dict),
+            "max_id": self.max_id,
+            "log_records": self._log_records,
+            "log_bytes": self._writer.offset if self._writer is not None else self._tail_offset,
+            "garbage_ratio": 1 - len(self._dict) / self._log_records if self._log_records else 0.0,
+            "compacting": self._compaction is not None,
+            "archived": len(self._cold),
+            "query_cache": len(self._query_cache) if self._query_cache is not None else None,
+            "indexes": {index: {"kind": values.kind, "values": len(values.distinct())}
+                        for index, values in self._indexes.items()},
+        }
+        if self._metrics is not None and hasattr(self._metrics, "snapshot"):
+            stats |= self._metrics.snapshot()
+        return stats
+
+
     def keys(self):
+        self._maybe_refresh()
         return self._dict.keys()
 
 
     def values(self, index) -> list[str]:
+        self._maybe_refresh()
         if index not in self._indexes:
             raise ValueError(f"No index {index} in db")
-        return self._indexes.get(index, {}).keys()
+        return self._indexes[index].distinct()
+
+
+    def aggregate(self, name, group=_MISSING):
+        self._maybe_refresh()
+        if name not in self._aggregates:
+            raise ValueError(f"No aggregate {name} in db")
+
+        aggregate = self._aggregates[name]
+        if group is not _MISSING:
+            return aggregate.total(group)
+        if aggregate.group_by is None:
+            return aggregate.total(None)
+        return aggregate.groups()
+
+
+    def range(self, index, lo=None, hi=None, /, reverse=False, limit=None, **kwargs):
+        if index not in self._indexes or self._indexes[index].kind != INDEX_SORTED:
+            raise ValueError(f"No sorted index {index} in db")
+
+        self._maybe_refresh()
+        filters = [self._compile(condition) for condition in self._parse_conditions(kwargs)]
+        found = 0
+        for key in self._indexes[index].range(lo, hi, reverse):
+            if limit is not None and found >= limit:
+                return
+            if key in self._dict and all(test(key) for test in filters):
+                found += 1
+                yield self._record(key)
+
+
+    @staticmethod
+    def _write_snapshot(filename, items, codec):
+        locations = {}
+        with open(filename, "wb") as f:
+            f.write(codec.header())
+            for k, v in items:
+                _, data = codec.encode(["set", k, v])
+                locations[k] = (f.tell(), len(data))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return locations
 
 
     def snapshot(self, filename):
-        with open(filename, "w") as f:
-            for k, v in self._dict.items():
-                f.write(json.dumps(["set", k, v], ensure_ascii=False) + "\n")
+        return self._write_snapshot(filename, self._dict.items(), self._codec.frozen())
+
+
+    def _start_compaction(self, tmp_file):
+        compaction = types.SimpleNamespace(tmp_file=tmp_file, base=self._writer.offset,
+                                           records=len(self._dict), locations=None, error=None,
+                                           started=time.perf_counter())
+
+        codec = self._codec.frozen()
+        decode = self._codec.decode
+        if self._lazy:
+            locators = self._dict.locators()
+
+            def items():
+                self._sync_log(compaction.base)
+                with open(self._filename, "rb") as f:
+                    def read(offset, length):
+                        f.seek(offset)
+                        return f.read(length)
+                    for key, locator in locators:
+                        yield key, _decode_entries(read, key, locator, decode)
+        else:
+            snapshot = list(self._dict.items())
+
+            def items():
+                return snapshot
+
+        def run():
+            try:
+                compaction.locations = self._write_snapshot(tmp_file, items(), codec)
+            except Exception as e:
+                compaction.error = e
+
+        compaction.thread = threading.Thread(target=run, name=f"baydb-compact:{self._filename}", daemon=True)
+        self._compaction = compaction
+        compaction.thread.start()
+
+
+    def _finish_compaction(self, raise_errors=True):
+        compaction, self._compaction = self._compaction, None
+        if compaction.error is not None:
+            if self._metrics is not None:
+                self._metrics.count("compaction.errors")
+            if os.path.exists(compaction.tmp_file):
+                os.remove(compaction.tmp_file)
+            self._compact_after = self._log_records + self._compact_min_records  # back off before retrying
+            if raise_errors:
+                raise compaction.error
+            return
+
+        with self._checkpoint_lock:
+            self._remove_checkpoints()
+            log_bytes = self._writer.offset
+            tail_start, tail = self._writer.swap(self._filename, compaction.tmp_file, compaction.base)
+            self._log_generation += 1
+        self._log_records = compaction.records + self._codec.count(tail)
+        if self._metrics is not None:
+            self._metrics.observe("compaction", time.perf_counter() - compaction.started)
+            self._metrics.count("compaction.runs")
+            self._metrics.count("compaction.bytes_reclaimed", log_bytes - self._writer.offset)
+        if self._lazy:
+            self._dict.relocate(compaction.locations, compaction.base, tail_start - compaction.base)
+        if self._checkpoint_every:
+            self._auto_checkpoint()
 
 
     def compact(self, file_suffix=".tmp"):
-        tmp_file = self._filename + file_suffix
-        self.snapshot(tmp_file)
-        os.rename(tmp_file, self._filename)
-        self._file.close()
-        self._file = open(self._filename, "a", encoding="utf8")
+        self._check_writable()
+        if self._compaction is None:
+            self._start_compaction(self._filename + file_suffix)
+        self._compaction.thread.join()
+        self._finish_compaction()
+
+
+class ShardedBayDB:
+    """
+    Partitions records across several BayDB files, filename.0 .. filename.N-1.
+    Records go to shard key % N, or by a stable hash of the shard_by field.
+    Shards load in parallel and write, checkpoint and compact independently;
+    keys, unique indexes and queries are global.
+    """
+
+    def __init__(self, filename, shards, indexes=[], shard_by=None, **kwargs):
+        if shards < 1:
+            raise ValueError("Need at least one shard")
+        if shard_by == "id":
+            raise ValueError("Shard by key with shard_by=None")
+
+        self._shard_by = shard_by
+        with concurrent.futures.ThreadPoolExecutor(max_workers=shards) as executor:
+            futures = [executor.submit(BayDB, f"{filename}.{n}", indexes, **kwargs) for n in range(shards)]
+        try:
+            self.shards = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                if future.exception() is None:
+                    future.result().close()
+            raise
+
+        self._unique_indexes = self.shards[0]._unique_indexes
+        self._key_shard = {}
+        if shard_by is not None:
+            for shard in self.shards:
+                for key in shard.keys():
+                    if key in self._key_shard:
+                        raise ValueError(f"Key {key} is stored in more than one shard")
+                    self._key_shard[key] = shard
+        self.max_id = max(shard.max_id for shard in self.shards)
+
+
+    def _shard_for_value(self, value):
+        if self._shard_by is None:
+            raise TypeError("Value routing needs shard_by")
+        data = json.dumps(value, ensure_ascii=False, sort_keys=True).encode()
+        return self.shards[zlib.crc32(data) % len(self.shards)]
+
+
+    def _shard_of(self, key):
+        if self._shard_by is None:
+            return self.shards[key % len(self.shards)]
+        if key not in self._key_shard:
+            # archived records are not routed on load, find their cold segment
+            return next((shard for shard in self.shards if key in shard._cold), None)
+        return self._key_shard.get(key)
+
+
+    def _check_unique(self, shard, key, value):
+        for index in self._unique_indexes:
+            for other in self.shards:
+                if other is not shard:
+                    other._check_unique(index, key, other._index_fields[index](value))
+
+
+    def __contains__(self, key):
+        shard = self._shard_of(key)
+        return shard is not None and key in shard
+
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.shards)
+
+
+    def append(self, value: dict) -> int:
+        if "id" in value:
+            raise ValueError("You can't insert element with 'id', use set")
+
+        return self.set(self.max_id + 1, value)
+
+
+    def set(self, key: int, value: dict):
+        if not isinstance(key, int):
+            raise TypeError("Key should be int")
+        if not isinstance(value, dict):
+            raise TypeError("Value should be dict")
+
+        if self._shard_by is None:
+            shard = self._shard_of(key)
+        else:
+            shard = self._shard_for_value(value.get(self._shard_by))
+            current = self._shard_of(key)
+            if current is not None and current is not shard:
+                raise ValueError(f"Record {key} can't move between shards, '{self._shard_by}' is fixed")
+        self._check_unique(shard, key, value)
+
+        record = shard.set(key, value)
+        if self._shard_by is not None:
+            self._key_shard[key] = shard
+        self.max_id = max(key, self.max_id)
+        return record
+
+
+    def update(self, key: int, **kwargs):
+        if not isinstance(key, int):
+            raise TypeError("Key should be int")
+        shard = self._shard_of(key)
+        if shard is None or key not in shard:
+            raise KeyError
+        if self._shard_by in kwargs and kwargs[self._shard_by] != shard.get(key).get(self._shard_by):
+            raise ValueError(f"Record {key} can't move between shards, '{self._shard_by}' is fixed")
+        self._check_unique(shard, key, shard.get(key) | kwargs)
+
+        record = shard.update(key, **kwargs)
+        if self._shard_by is not None:
+            self._key_shard[key] = shard  # an archived record is back in the hot set, route it from now on
+        return record
+
+
+    def delete(self, key: int):
+        shard = self._shard_of(key)
+        if shard is not None:
+            self._key_shard.pop(key, None)
+            return shard.delete(key)
+
+
+    def get(self, key: int=None, /, **kwargs):
+        if "id" in kwargs:
+            key = kwargs["id"]
+
+        if key is not None:
+            shard = self._shard_of(key)
+            return shard.get(key) if shard is not None else None
+
+        for shard in self.shards:
+            record = shard.get(**kwargs)
+            if record is not None:
+                return record
+
+
+    def _query_shards(self, kwargs):
+        if self._shard_by in kwargs:
+            return [self._shard_for_value(kwargs[self._shard_by])]
+        return self.shards
+
+
+    def where(self, first=False, /, limit=None, after=None, order_by=None, **kwargs):
+        if not kwargs and limit is None:
+            raise ValueError("Bad args in where")
+
+        if limit is not None:
+            return self._page(kwargs, limit, after, order_by)
+
+        ans = itertools.chain.from_iterable(shard.where(**kwargs) for shard in self._query_shards(kwargs))
+        if first:
+            for a in ans:
+                return a
+            return None
+        return ans
+
+
+    def _page(self, kwargs, limit, after, order_by):
+        # a cursor is a position in the global order, so it resumes every shard
+        pages = [shard.where(limit=limit, after=after, order_by=order_by, **kwargs)
+                 for shard in self._query_shards(kwargs)]
+        field, reverse = _order_field(order_by)
+        fields = self.shards[0]._index_fields
+
+        def position(record):
+            if field is None:
+                return (record.id,)
+            value = fields[field](record) if field in fields else _Field(field)(record)
+            return (value is not None, value, record.id)
+
+        records = list(heapq.merge(*(page.records for page in pages), key=position, reverse=reverse))
+        more = len(records) > limit or any(page.cursor for page in pages)
+        records = records[:limit]
+        return Page(records, _encode_cursor(position(records[-1])) if more else None)
+
+
+    def query(self, select=None, /, **kwargs):
+        return itertools.chain.from_iterable(shard.query(select, **kwargs) for shard in self._query_shards(kwargs))
+
+
+    def count(self, **kwargs):
+        return sum(shard.count(**kwargs) for shard in self._query_shards(kwargs))
+
+
+    def keys(self):
+        return itertools.chain.from_iterable(shard.keys() for shard in self.shards)
+
+
+    def archive(self, **kwargs) -> int:
+        return sum(shard.archive(**kwargs) for shard in self._query_shards(kwargs))
+
+
+    def archived(self, **kwargs):
+        return itertools.chain.from_iterable(shard.archived(**kwargs) for shard in self._query_shards(kwargs))
+
+
+    def stats(self):
+        return {"shards": [shard.stats() for shard in self.shards]}
+
+
+    def values(self, index) -> list[str]:
+        return list(dict.fromkeys(itertools.chain.from_iterable(shard.values(index) for shard in self.shards)))
+
+
+    def aggregate(self, name, group=_MISSING):
+        totals = [shard.aggregate(name, group) for shard in self.shards]
+        if not isinstance(totals[0], dict):
+            return sum(totals)
+
+        merged = {}
+        for total in totals:
+            for item, value in total.items():
+                if isinstance(value, dict):
+                    counters = merged.setdefault(item, {})
+                    for subitem, number in value.items():
+                        counters[subitem] = counters.get(subitem, 0) + number
+                else:
+                    merged[item] = merged.get(item, 0) + value
+        return merged
+
+
+    def range(self, index, lo=None, hi=None, /, reverse=False, limit=None, **kwargs):
+        field = self.shards[0]._index_fields[index]
+
+        def order(record):
+            value = field(record)
+            return value is not None, value, record.id
+
+        ranges = [shard.range(index, lo, hi, reverse=reverse, limit=limit, **kwargs)
+                  for shard in self._query_shards(kwargs)]
+        return itertools.islice(heapq.merge(*ranges, key=order, reverse=reverse), limit)
+
+
+    def subscribe(self, callback, **kwargs):
+        return [shard.subscribe(callback, **kwargs) for shard in self.shards]
+
+
+    def unsubscribe(self, subscriptions):
+        for shard, subscription in zip(self.shards, subscriptions):
+            shard.unsubscribe(subscription)
+
+
+    def refresh(self):
+        for shard in self.shards:
+            shard.refresh()
+        self.max_id = max(shard.max_id for shard in self.shards)
+        if self._shard_by is not None:
+            self._key_shard = {key: shard for shard in self.shards for key in shard.keys()}
+
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+
+    def checkpoint(self):
+        for shard in self.shards:
+            shard.checkpoint()
+
+
+    def compact(self, file_suffix=".tmp"):
+        for shard in self.shards:
+            shard.compact(file_suffix)
+
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class AsyncBayDB:
+    """
+    Asyncio facade over BayDB. Reads are answered from memory right away,
+    mutations are applied in memory and then awaited until the writer
+    thread has committed them to the log. When more than max_pending_bytes
+    are waiting to be written, new mutations wait for the writer first.
+    """
+
+    def __init__(self, filename, indexes=[], max_pending_bytes=1 << 20, **kwargs):
+        kwargs.setdefault("durability", DURABILITY_GROUP)
+        if kwargs["durability"] == DURABILITY_FLUSH:
+            raise ValueError("AsyncBayDB needs a group commit durability mode")
+
+        self.db = BayDB(filename, indexes, **kwargs)
+        self.db._background_checkpoints = True
+        self._max_pending_bytes = max_pending_bytes
+
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+    def __contains__(self, key):
+        return key in self.db
+
+
+    def __iter__(self):
+        return iter(self.db)
+
+
+    async def _written(self, offset):
+        writer = self.db._writer
+        if writer.written >= offset:
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve():
+            if not future.done():
+                future.set_result(None)
+
+        writer.notify_written(offset, lambda: loop.call_soon_threadsafe(resolve))
+        await future
+
+
+    async def _mutate(self, method, *args, **kwargs):
+        writer = self.db._writer
+        while writer.offset - writer.written > self._max_pending_bytes:
+            await self._written(writer.offset)
+
+        result = method(*args, **kwargs)
+        await self._written(writer.offset)
+        return result
+
+
+    async def set(self, key: int, value: dict):
+        return await self._mutate(self.db.set, key, value)
+
+
+    async def append(self, value: dict):
+        return await self._mutate(self.db.append, value)
+
+
+    async def update(self, key: int, **kwargs):
+        return await self._mutate(self.db.update, key, **kwargs)
+
+
+    async def delete(self, key: int):
+        return await self._mutate(self.db.delete, key)
+
+
+    async def archive(self, **kwargs):
+        return await self._mutate(self.db.archive, **kwargs)
+
+
+    async def apply(self, ops):
+        return await self._mutate(self.db.apply, ops)
+
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        # Mutations inside use the synchronous db: awaiting in the middle of
+        # a batch would let other tasks' writes leak into it
+        with self.db.batch():
+            yield self.db
+        await self._written(self.db._writer.offset)
+
+
+    async def flush(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.db.flush)
+
+
+    async def checkpoint(self):
+        checkpoint = self.db._checkpoint_state()
+        await asyncio.get_running_loop().run_in_executor(None, self.db._write_checkpoint, *checkpoint)
+
+
+    async def compact(self):
+        if self.db._compaction is None:
+            self.db._start_compaction(self.db._filename + ".tmp")
+        compaction = self.db._compaction
+        await asyncio.get_running_loop().run_in_executor(None, compaction.thread.join)
+        # a write may have finished it meanwhile and started the next one
+        if self.db._compaction is compaction:
+            self.db._finish_compaction()
+
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.db.close)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BayDB log tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="rewrite a log in another format")
+    convert.add_argument("source")
+    convert.add_argument("target")
+    convert.add_argument("format", choices=LOG_FORMATS)
+    args = parser.parse_args()
+    print(f"{convert_log(args.source, args.target, args.format)} entries written to {args.target}")
@@ -0,0 +1,222 @@
+"""
+Benchmarks BayDB on order-shaped records with status churn.
+
+For every data size it measures write throughput (set/update/delete),
+log replay on startup with and without a checkpoint, where/get/range
+latency, index memory and compaction. Results are printed as JSON so
+runs can be compared between commits.
+
+Examples:
+    python bench_baydb.py
+    python bench_baydb.py --sizes 10000,100000,1000000 --output bench.json
+    python bench_baydb.py --sizes 100000 --lazy --durability group
+    python bench_baydb.py --log-format binary
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import baydb
+
+
+STATUSES = ["NEW", "WAITING_PAYMENT", "WAITING_APPROVE", "PAID", "READY", "DONE"]
+ITEMS = ["tshirt_S", "tshirt_M", "tshirt_L", "tshirt_XL", "hoodie_M", "hoodie_L",
+         "rubashka_48", "rubashka_50", "sticker", "mug", "rain_S_M", "rain_XL_XXL"]
+DELIVERIES = ["pvz", "courier_ekb", "worldwide", "other"]
+INDEXES = ["status", "user_id", "payment_transaction_id", ("create_time", "sorted")]
+
+
+def make_order(rnd, create_time):
+    items = {item: rnd.randint(1, 3) for item in rnd.sample(ITEMS, rnd.randint(1, 4))}
+    delivery_id = rnd.choice(DELIVERIES)
+    return {
+        "user_id": rnd.randint(1, 50_000),
+        "user_nick": f"user{rnd.randint(1, 50_000)}",
+        "user_name": "Иван Иванов",
+        "order": {
+            "order": items,
+            "total_price": sum(items.values()) * 1500,
+            "currency": "RUB",
+            "orig_currency": "RUB",
+            "delivery": delivery_id,
+            "delivery_id": delivery_id,
+            "delivery_details": {"city": "Екатеринбург", "recipient_name": "Иван Иванов",
+                                 "recipient_phone": "+79000000000", "pvz_link": "https://example.com/pvz"},
+        },
+        "status": "NEW",
+        "create_time": create_time,
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def latency(function, runs):
+    samples = []
+    for _ in range(runs):
+        elapsed, _ = timed(function)
+        samples.append(elapsed * 1e6)
+    samples.sort()
+    return {
+        "runs": runs,
+        "mean_us": round(statistics.fmean(samples), 2),
+        "p50_us": round(samples[len(samples) // 2], 2),
+        "p99_us": round(samples[min(len(samples) - 1, len(samples) * 99 // 100)], 2),
+    }
+
+
+def throughput(ops, elapsed):
+    return {"ops": ops, "seconds": round(elapsed, 4), "ops_per_sec": round(ops / elapsed) if elapsed else None}
+
+
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def open_db(filename, args, **kwargs):
+    return baydb.BayDB(filename, INDEXES, durability=args.durability, lazy=args.lazy, log_format=args.log_format,
+                       **kwargs)
+
+
+def write_phase(db, rnd, size):
+    start_time = 1_700_000_000
+    records = [make_order(rnd, start_time + i) for i in range(size)]
+    elapsed, _ = timed(lambda: [db.append(record) for record in records])
+    results = {"append": throughput(size, elapsed)}
+
+    # every order moves through a few statuses, some get paid with a transaction id
+    updates = 0
+    start = time.perf_counter()
+    for key in range(size):
+        for status in STATUSES[1:rnd.randint(1, len(STATUSES) - 1) + 1]:
+            if status == "PAID":
+                db.update(key, status=status, payment_transaction_id=f"tx{key}")
+            else:
+                db.update(key, status=status)
+            updates += 1
+    results["update"] = throughput(updates, time.perf_counter() - start)
+
+    canceled = rnd.sample(range(size), size // 20)
+    elapsed, _ = timed(lambda: [db.update(key, status="CANCELED") for key in canceled])
+    results["cancel"] = throughput(len(canceled), elapsed)
+
+    deleted = rnd.sample(range(size), size // 50)
+    elapsed, _ = timed(lambda: [db.delete(key) for key in deleted])
+    results["delete"] = throughput(len(deleted), elapsed)
+
+    elapsed, _ = timed(db.flush)
+    results["flush_seconds"] = round(elapsed, 4)
+    return results
+
+
+def query_phase(db, rnd, size, runs):
+    return {
+        "get": latency(lambda: db.get(rnd.randrange(size)), runs),
+        "where_status": latency(lambda: list(db.where(status="WAITING_APPROVE")), max(runs // 100, 5)),
+        "where_user": latency(lambda: list(db.where(user_id=rnd.randint(1, 50_000), status__ne="CANCELED")), runs),
+        "where_first": latency(lambda: db.where(True, status="DONE"), runs),
+        "range_latest": latency(lambda: list(db.range("create_time", reverse=True, limit=20)), runs),
+        "values_transactions": latency(lambda: db.values("payment_transaction_id"), max(runs // 100, 5)),
+    }
+
+
+def index_phase(db):
+    return {
+        index: {"kind": values.kind, "distinct": len(values.distinct()), "bytes": deep_size(values)}
+        for index, values in db._indexes.items()
+    }
+
+
+def bench_size(size, args, directory):
+    rnd = random.Random(args.seed)
+    filename = os.path.join(directory, f"orders_{size}.json")
+    result = {"size": size}
+
+    db = open_db(filename, args)
+    result["write"] = write_phase(db, rnd, size)
+    result["log_bytes"] = os.path.getsize(filename)
+    db.close()
+
+    load_seconds, db = timed(open_db, filename, args)
+    result["load"] = {"replay_seconds": round(load_seconds, 4), "log_bytes": os.path.getsize(filename)}
+    result["queries"] = query_phase(db, rnd, size, args.runs)
+    result["indexes"] = index_phase(db)
+
+    checkpoint_seconds, _ = timed(db.checkpoint)
+    db.close()
+    load_seconds, db = timed(open_db, filename, args)
+    result["load"]["checkpoint_write_seconds"] = round(checkpoint_seconds, 4)
+    result["load"]["from_checkpoint_seconds"] = round(load_seconds, 4)
+
+    compact_seconds, _ = timed(db.compact)
+    result["compact"] = {
+        "seconds": round(compact_seconds, 4),
+        "bytes_before": result["log_bytes"],
+        "bytes_after": os.path.getsize(filename),
+    }
+    db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BayDB on order-shaped records")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma separated record counts (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=1000, help="samples per latency measurement")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--durability", default=baydb.DURABILITY_FLUSH, choices=baydb.DURABILITY_MODES)
+    parser.add_argument("--lazy", action="store_true", help="open databases in lazy mode")
+    parser.add_argument("--log-format", default=baydb.LOG_JSON, choices=baydb.LOG_FORMATS)
+    parser.add_argument("--dir", help="where to keep the database files (default: a temporary directory)")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "durability": args.durability,
+        "lazy": args.lazy,
+        "log_format": args.log_format,
+        "seed": args.seed,
+        "results": [],
+    }
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for size in sizes:
+            print(f"benchmarking {size} records", file=sys.stderr)
+            report["results"].append(bench_size(size, args, directory))
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -148,7 +148,7 @@ async def approve(bot, orders):
                                 log.info(f"Найден подтвержденный платеж ID {payment_id} для {user_name} ({username})")
                                 
                                 # Обновляем статус заказа и сохраняем ID транзакции
-                                order = orders.update(order_id, status="PAID", payment_transaction_id=payment_id)
+                                order = await orders.update(order_id, status="PAID", payment_transaction_id=payment_id)
                                 
                                 # Отмечаем транзакцию как обработанную в кэше
                                 processed_transactions.add(payment_id)
@@ -194,14 +194,8 @@ async def load_processed_transactions(orders):
     """
     log.info("Загрузка обработанных транзакций из базы данных")
     
-    # Загружаем все заказы, у которых есть ID транзакции
-    all_orders = list(orders.keys())
-    transaction_ids = []
-    
-    for order_id in all_orders:
-        order = orders.get(order_id)
-        if order and order.get("payment_transaction_id"):
-            transaction_ids.append(order["payment_transaction_id"])
+    # ID транзакций берём прямо из индекса, без обхода всех заказов
+    transaction_ids = [transaction_id for transaction_id in orders.values("payment_transaction_id") if transaction_id]
     
     if transaction_ids:
         processed_transactions.update(transaction_ids)
@@ -217,8 +211,18 @@ async def pay_approver(bot, orders):
     
     # Загружаем обработанные транзакции при старте
     await load_processed_transactions(orders)
+
+    # Просыпаемся сразу, как только заказ переходит в ожидание подтверждения
+    new_waiting_order = asyncio.Event()
+
+    def on_change(change):
+        if change.new is not None and change.new.get("status") == "WAITING_APPROVE":
+            new_waiting_order.set()
+
+    orders.subscribe(on_change, status="WAITING_APPROVE")
     
     while True:
+        new_waiting_order.clear()
         try:
             # Проверяем платежи
             await asyncio.wait_for(approve(bot, orders), timeout=TASK_TIMEOUT)
@@ -227,4 +231,10 @@ async def pay_approver(bot, orders):
         except Exception as e:
             log.exception(f"Ошибка в автоматическом подтверждении платежей: {str(e)}")
         finally:
-            await asyncio.sleep(PAUSE)
\ No newline at end of file
+            # Пока есть неподтверждённые заказы, опрашиваем сайт раз в PAUSE секунд,
+            # иначе ждём появления нового такого заказа
+            has_waiting = orders.where(True, status="WAITING_APPROVE") is not None
+            try:
+                await asyncio.wait_for(new_waiting_order.wait(), timeout=PAUSE if has_waiting else None)
+            except asyncio.TimeoutError:
+                pass
\ No newline at end of file